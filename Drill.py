@@ -3,7 +3,7 @@
 
 import pangloss
 
-import sys,glob,getopt,numpy
+import sys,glob,getopt,numpy,itertools,multiprocessing,shutil
 
 from math import pi
 
@@ -28,8 +28,31 @@ def Drill(argv):
         and the true kappa value for each line of sight is also extracted
         and passed on. Lightcone catalogs are stored as pickles.
 
+        Calibration cones are placed according to SamplingMethod: random
+        (the default), on a regular lattice, along a Halton low-discrepancy
+        sequence, or by Poisson disk sampling with no two cones closer than
+        SamplingSeparation lightcone radii. Evenly spread cones overlap
+        less, so fewer of them are needed for the same calibration. The
+        positions are drawn from RandomSeed, if it is given, so that a
+        repeated run drills the same cones.
+
+        If CutCalibrationLightcones is True, galaxies fainter than
+        LightconeDepth (or the deepest PhotometricDepth, if shallower) and
+        beyond SourceRedshift+0.2 (or the deepest of SourceRedshifts+0.2)
+        are left out of the calibration lightcones, since Reconstruct
+        would discard them anyway. This is off by default, because
+        Magnifier's lightcone density counts (lc_density.txt) use all the
+        galaxies in a cone, at any redshift. The observed lightcone is
+        never cut.
+
+        Calibration catalogs too big to fit in memory can be streamed
+        through in chunks of CatalogChunkSize rows: each chunk's galaxies
+        are routed to the cones they fall in, so memory use is set by the
+        chunk size and the cones, not by the catalog.
+
     FLAGS
         -h            Print this message [0]
+        -j, --jobs N  Drill calibration cones with N processes [1]
 
     INPUTS
         configfile    Plain text file containing Pangloss configuration
@@ -42,6 +65,8 @@ def Drill(argv):
 
         Drill.py example.config
 
+        Drill.py --jobs 64 example.config
+
     BUGS
 
     AUTHORS
@@ -56,16 +81,20 @@ def Drill(argv):
     # --------------------------------------------------------------------
 
     try:
-        opts, args = getopt.getopt(argv,"h",["help"])
+        opts, args = getopt.getopt(argv,"hj:",["help","jobs="])
     except getopt.GetoptError, err:
         print str(err) # will print something like "option -a not recognized"
         print Drill.__doc__  # will print the big comment above.
         return
 
+    jobs = 1
     for o,a in opts:
         if o in ("-h", "--help"):
             print Drill.__doc__
             return
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+            assert jobs > 0, "need at least one job"
         else:
             assert False, "unhandled option"
 
@@ -125,66 +154,63 @@ def Drill(argv):
 
         flavor = 'simulated'
 
-        count = 0
-        Ncones = Nc/Ncalcats
-
-        for i,catalog in enumerate(calcats):
-
-            print "Drill: Reading in calibration catalog from "+catalog+"..."
-            table = pangloss.readCatalog(catalog,experiment)
-
-            if units == 'deg':
-                table['nRA'] = -table['nRA'] * pangloss.deg2rad
-                table['Dec'] = table['Dec'] * pangloss.deg2rad
-                table['Mhalo_obs'] = table['Mhalo_obs'] * 1E10
-                table['Mstar_obs'] = table['Mstar_obs'] * 1E10
-            ###
-            #dx = Rc*1.000001*pangloss.arcmin2rad
-            #subtable =table.where((table['pos_0[rad]'] > (-dx)) & \
-            #                      (table['pos_0[rad]'] < (+dx)) & \
-            #                      (table['pos_1[rad]'] > (-dx)) & \
-            #                      (table['pos_1[rad]'] < (+dx))   )
-
-
-            print "Drill: Sampling sky positions in",units,"..."
-            x,y = sample_sky(table,Rc,Ncones,method='random')
-
-            if kappamaps is not None:
-                print "Drill: Reading in kappa map from "+kappamaps[i]
-                MSconvergence = pangloss.Kappamap(kappamaps[i])
-
-            # Coming soon...
-            #   gammafile1 = gamma1[i]
-            #   MSgamma1 = kappamap.Kappamap(gammafile1)
-            #   gammafile2 = gamma2[i]
-            #   MSgamma2 = kappamap.Kappamap(gammafile2)
-
-            print "Drill: Pickling lightcones from this patch of sky..."
-            for k in range(Ncones):
-                if k % 200 == 0 and k !=0:
-                    print ("Drill: ...on cone %i out of %i..." % (k,Ncones))
-
-                lc = pangloss.Lightcone(table,'simulated',[x[k],y[k]],Rc)
-
-                if kappamaps is not None:
-                    lc.kappa_hilbert = MSconvergence.at(x[k],y[k],coordinate_system='physical')
-
-                # Coming soon...
-                #   lc.gamma1_hilbert = MSgamma1.at(x[k],y[k],coordinate_system='physical')
-                #   lc.gamma2_hilbert = MSgamma2.at(x[k],y[k],coordinate_system='physical')
-
-                calpickle = experiment.getLightconePickleName('simulated',pointing=count)
-                pangloss.writePickle(lc,calpickle)
-
-                count += 1
-
+        # Share the cones out evenly between the patches, and number them
+        # in patch order, so that every cone gets the same pointing number
+        # however the work is divided up:
+        Ncones = [Nc/Ncalcats + (i < Nc%Ncalcats) for i in range(Ncalcats)]
+        first = numpy.cumsum([0]+Ncones)
+
+        # The sky positions in each patch are drawn from their own seed,
+        # so that all the processes drilling that patch agree on them, and
+        # a given RandomSeed always puts the cones in the same places:
+        seed = experiment.parameters.get('RandomSeed')
+        if seed is None:
+            seed = numpy.random.randint(2**31-Ncalcats)
+            print "Drill: no RandomSeed given, using",seed
+        seed = int(seed)
+
+        # Split the patches into enough batches of cones to keep all the
+        # processes busy:
+        Nbatches = int(numpy.ceil(float(jobs)/Ncalcats))
+        tasks = []
+        for i in range(Ncalcats):
+            batchsize = max(1,int(numpy.ceil(float(Ncones[i])/Nbatches)))
+            for start in range(0,Ncones[i],batchsize):
+                stop = min(start+batchsize,Ncones[i])
+                tasks.append((experiment,i,Ncones[i],first[i],start,stop,seed+i))
+
+        # Start any lightcone store afresh, rather than mixing old and new:
+        storename = experiment.getLightconeStoreName()
+        if storename is not None:
+            print "Drill: Writing lightcones to the store in "+storename
+            shutil.rmtree(storename,ignore_errors=True)
+
+        # Streamed catalogs are read from their binary column caches. The
+        # batches of a patch would all race to make the same cache, so make
+        # each one first (one process per catalog):
+        chunksize = int(experiment.parameters.get('CatalogChunkSize',0))
+        caching = []
+        if chunksize > 0:
+            caching = [(experiment,catalog,chunksize) for catalog in sorted(set(calcats))]
+
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            if len(caching) > 0:
+                print "Drill: Caching %i calibration catalogs..." % len(caching)
+                pool.map(cache_catalog,caching)
+            print "Drill: Sharing %i batches of cones between %i processes..." % (len(tasks),jobs)
+            done = pool.imap_unordered(drill_batch,tasks)
+        else:
+            map(cache_catalog,caching)
+            done = itertools.imap(drill_batch,tasks)
 
-            # Save memory!
-            del table
-            del lc
-            del catalog
+        count = 0
+        for n in done:
+            count += n
 
-            print "Drill: ...done."
+        if jobs > 1:
+            pool.close()
+            pool.join()
 
         print ("Drill: All %i calibration lightcones made." % (count))
 
@@ -201,6 +227,8 @@ def Drill(argv):
             table = pangloss.readCatalog(obscat,experiment)
 
             xc = [x0,y0]
+            # The observed cone is drilled uncut: its galaxies are
+            # selected later, by configureForSurvey.
             lc = pangloss.Lightcone(table,'real',xc,Rc)
 
             obspickle = experiment.getLightconePickleName('real')
@@ -214,9 +242,175 @@ def Drill(argv):
     return
 
 # ======================================================================
-# Draw calibration sightlines at random:
+# Make the binary column cache of a calibration catalog, for streaming:
+
+def cache_catalog(task):
+    experiment,catalog,chunksize = task
+    pangloss.makeCatalogCache(catalog,experiment,chunksize)
+    return
+
+# ======================================================================
+# Drill one batch of calibration cones out of one patch of sky, and pickle
+# them (or add them to the lightcone store, a shard at a time). In --jobs
+# mode this runs in the worker processes, so it is given
+# everything it needs in one tuple, and reads in the patch itself. Each
+# process keeps the last patch it read, since consecutive batches usually
+# come from the same one.
 
-def sample_sky(table,Rc,Nc,method='random'):
+patch = {}
+
+def drill_batch(task):
+
+    experiment,i,Ncones,first,start,stop,seed = task
+
+    Rc = experiment.parameters['LightconeRadius'] # in arcmin
+    catalog = experiment.parameters['CalibrationCatalogs'][i]
+    kappamaps = experiment.parameters['CalibrationKappamaps']
+    units = experiment.parameters['Units']
+    method = experiment.parameters.get('SamplingMethod','random')
+    separation = experiment.parameters.get('SamplingSeparation',2.0)
+    chunksize = int(experiment.parameters.get('CatalogChunkSize',0))
+    cuts = drill_cuts(experiment)
+
+    if patch.get('number') != i:
+        patch.clear()
+
+        if chunksize > 0:
+            # Only the catalog limits are needed to place the cones, so
+            # stream through the catalog just to find them:
+            print "Drill: Streaming calibration catalog from "+catalog+" in chunks of %i rows..." % chunksize
+            xmin,xmax,ymin,ymax = numpy.inf,-numpy.inf,numpy.inf,-numpy.inf
+            for chunk in pangloss.readCatalogChunks(catalog,experiment,chunksize):
+                chunk = convert_units(chunk,units)
+                if len(chunk) == 0: continue
+                xmin,xmax = min(xmin,chunk['nRA'].min()),max(xmax,chunk['nRA'].max())
+                ymin,ymax = min(ymin,chunk['Dec'].min()),max(ymax,chunk['Dec'].max())
+            table = {'nRA':numpy.array([xmin,xmax]),'Dec':numpy.array([ymin,ymax])}
+            index = None
+        else:
+            print "Drill: Reading in calibration catalog from "+catalog+"..."
+            table = convert_units(pangloss.readCatalog(catalog,experiment),units)
+            ###
+            #dx = Rc*1.000001*pangloss.arcmin2rad
+            #subtable =table.where((table['pos_0[rad]'] > (-dx)) & \
+            #                      (table['pos_0[rad]'] < (+dx)) & \
+            #                      (table['pos_1[rad]'] > (-dx)) & \
+            #                      (table['pos_1[rad]'] < (+dx))   )
+
+            print "Drill: Indexing catalog sky positions..."
+            index = pangloss.SkyIndex(table,Rc)
+
+        print "Drill: Sampling sky positions in",units,"by",method,"..."
+        x,y = sample_sky(table,Rc,Ncones,method=method,separation=separation,rng=numpy.random.RandomState(seed))
+
+        kappa = None
+        if kappamaps is not None:
+            print "Drill: Reading in kappa map from "+kappamaps[i]
+            MSconvergence = pangloss.Kappamap(kappamaps[i])
+            kappa = MSconvergence.at(x,y,coordinate_system='physical')
+
+        # Coming soon...
+        #   gammafile1 = gamma1[i]
+        #   MSgamma1 = kappamap.Kappamap(gammafile1)
+        #   gammafile2 = gamma2[i]
+        #   MSgamma2 = kappamap.Kappamap(gammafile2)
+
+        patch.update(number=i,table=table,index=index,x=x,y=y,kappa=kappa)
+
+    x,y,kappa = patch['x'],patch['y'],patch['kappa']
+
+    storename = experiment.getLightconeStoreName()
+    if storename is not None:
+        store = pangloss.LightconeStore(storename)
+        shard,pointings = [],[]
+
+    print "Drill: Pickling lightcones %i to %i from patch %i..." % (first+start,first+stop-1,i)
+    positions = numpy.array([x[start:stop],y[start:stop]]).T
+    if chunksize > 0:
+        # Stream through the catalog again, routing rows to these cones:
+        chunks = itertools.imap(lambda chunk: convert_units(chunk,units),
+                    pangloss.readCatalogChunks(catalog,experiment,chunksize))
+        limits = patch['table']['nRA'].tolist()+patch['table']['Dec'].tolist()
+        cones = pangloss.drillLightconesFromChunks(chunks,'simulated',positions,Rc,limits,**cuts)
+    else:
+        cones = pangloss.drillLightcones(patch['table'],'simulated',positions,Rc,index=patch['index'],**cuts)
+    for k,lc in enumerate(cones,start):
+        if k % 200 == 0 and k != start:
+            print ("Drill: ...on cone %i out of %i..." % (k,Ncones))
+
+        if kappa is not None:
+            lc.kappa_hilbert = kappa[k]
+
+        # Coming soon...
+        #   lc.gamma1_hilbert = MSgamma1.at(x[k],y[k],coordinate_system='physical')
+        #   lc.gamma2_hilbert = MSgamma2.at(x[k],y[k],coordinate_system='physical')
+
+        if storename is None:
+            calpickle = experiment.getLightconePickleName('simulated',pointing=first+k)
+            pangloss.writePickle(lc,calpickle)
+        else:
+            shard.append(lc)
+            pointings.append(first+k)
+            if len(shard) == 1000 or k == stop-1:
+                store.write(shard,pointings)
+                shard,pointings = [],[]
+
+    return stop-start
+
+# ======================================================================
+# Galaxies that Reconstruct would throw away can be left out of the
+# lightcones in the first place:
+#   depth    - LightconeDepth in LightconeDepthBand, but no deeper than the
+#                deepest PhotometricDepth, since configureForSurvey drops
+#                anything fainter
+#   redshift - z_obs < SourceRedshift + 0.2, as in defineSystem, or the
+#                deepest of SourceRedshifts + 0.2 if that is further
+# The cuts are recorded in each Lightcone (maglimit, band, zmax). They are
+# only made if CutCalibrationLightcones is True, since Magnifier counts
+# galaxies at all redshifts when it works out the cones' densities.
+
+def drill_cuts(experiment):
+
+    if experiment.parameters.get('CutCalibrationLightcones','False') not in ('True','true'):
+        return {}
+
+    maglimit = experiment.parameters.get('LightconeDepth',99)
+    PD = experiment.parameters['PhotometricDepth']
+    if PD != ['']: maglimit = min(maglimit,max(PD))
+    band = experiment.parameters.get('LightconeDepthBand','r')
+    zsources = [experiment.parameters['SourceRedshift']] + experiment.getSourceRedshifts()
+    zmax = max(zsources) + 0.2
+
+    return dict(maglimit=maglimit,band=band,zmax=zmax)
+
+# ======================================================================
+# Simulated catalogs in degrees need converting to radians, and their masses
+# to solar masses:
+
+def convert_units(table,units):
+
+    if units == 'deg':
+        table['nRA'] = -table['nRA'] * pangloss.deg2rad
+        table['Dec'] = table['Dec'] * pangloss.deg2rad
+        table['Mhalo_obs'] = table['Mhalo_obs'] * 1E10
+        table['Mstar_obs'] = table['Mstar_obs'] * 1E10
+
+    return table
+
+# ======================================================================
+# Choose Nc calibration sightlines in a patch of sky, keeping every cone
+# inside the catalog. Methods are:
+#   random   - uniform random positions (cones may overlap heavily)
+#   lattice  - centres of a regular grid of Nc cells, as near square as
+#                the patch allows
+#   halton   - the (2,3) Halton low-discrepancy sequence, from a random
+#                starting point
+#   poisson  - random positions, but no two closer than separation
+#                lightcone radii (Poisson disk sampling, by dart throwing)
+# The more evenly the cones cover the patch, the more independent
+# information each one carries.
+
+def sample_sky(table,Rc,Nc,method='random',separation=2.0,rng=numpy.random):
 
     xmax = table['nRA'].max()
     xmin = table['nRA'].min()
@@ -225,13 +419,88 @@ def sample_sky(table,Rc,Nc,method='random'):
 
     Rcrad = Rc*pangloss.arcmin2rad
 
+    # Region available to cone centres:
+    x0,x1 = xmin+Rcrad,xmax-Rcrad
+    y0,y1 = ymin+Rcrad,ymax-Rcrad
+    assert x1 > x0 and y1 > y0, "catalog is too small for lightcones of radius %.2f arcmin" % Rc
+
     if method == 'random':
-        x = numpy.random.uniform(xmin+Rcrad,xmax-Rcrad,Nc)
-        y = numpy.random.uniform(ymin+Rcrad,ymax-Rcrad,Nc)
+        x = rng.uniform(x0,x1,Nc)
+        y = rng.uniform(y0,y1,Nc)
+
+    elif method == 'lattice':
+        nx = int(numpy.ceil(numpy.sqrt(Nc*(x1-x0)/(y1-y0))))
+        ny = int(numpy.ceil(float(Nc)/nx))
+        i,j = numpy.divmod(numpy.arange(Nc),ny)
+        x = x0 + (i+0.5)*(x1-x0)/nx
+        y = y0 + (j+0.5)*(y1-y0)/ny
+
+    elif method == 'halton':
+        skip = rng.randint(1000000)
+        x = x0 + halton(Nc,2,skip)*(x1-x0)
+        y = y0 + halton(Nc,3,skip)*(y1-y0)
+
+    elif method == 'poisson':
+        x,y = poisson_disk(x0,x1,y0,y1,Nc,separation*Rcrad,rng)
+
     else:
-        assert False
+        assert False, "unknown sampling method "+method
+
     return x,y
 
+# ----------------------------------------------------------------------
+# Elements skip to skip+N-1 of the van der Corput sequence in base b:
+
+def halton(N,b,skip=0):
+
+    i = numpy.arange(skip+1,skip+N+1)
+    h = numpy.zeros(N)
+    f = 1.0
+    while i.any():
+        f /= b
+        i,digit = numpy.divmod(i,b)
+        h += f*digit
+
+    return h
+
+# ----------------------------------------------------------------------
+# Throw darts at the rectangle, keeping those at least d from all the
+# others. A grid of cells of side d/sqrt(2) holds at most one dart each,
+# so only the 5x5 cells around a new dart need checking.
+
+def poisson_disk(x0,x1,y0,y1,N,d,rng,maxtries=10000):
+
+    # Hexagonal packing is the best that can possibly be done:
+    capacity = int((x1-x0+d)*(y1-y0+d)/(0.5*numpy.sqrt(3.0)*d*d))
+    assert N <= capacity, "cannot fit %i cones %.2f arcmin apart in this patch - try a smaller SamplingSeparation" % (N,d*pangloss.rad2arcmin)
+
+    cell = d/numpy.sqrt(2.0)
+    nx = int((x1-x0)/cell) + 1
+    ny = int((y1-y0)/cell) + 1
+    grid = -numpy.ones((nx+4,ny+4),dtype=int)
+
+    x,y = numpy.zeros(N),numpy.zeros(N)
+    n,misses = 0,0
+    while n < N:
+        assert misses < maxtries, "only found room for %i of %i cones %.2f arcmin apart - try a smaller SamplingSeparation" % (n,N,d*pangloss.rad2arcmin)
+
+        xt = rng.uniform(x0,x1)
+        yt = rng.uniform(y0,y1)
+        i = int((xt-x0)/cell) + 2
+        j = int((yt-y0)/cell) + 2
+
+        near = grid[i-2:i+3,j-2:j+3]
+        near = near[near >= 0]
+        if numpy.any((x[near]-xt)**2 + (y[near]-yt)**2 < d*d):
+            misses += 1
+            continue
+
+        grid[i,j] = n
+        x[n],y[n] = xt,yt
+        n += 1
+        misses = 0
+
+    return x,y
 
 # ======================================================================
 
@@ -47,6 +47,12 @@ def Magnifier(argv):
                             names, can be None
                             If FieldName is none, FieldOverdensity can be a list
                             of overdensities, e.g. [0.75, 1.0, 1.25] for testing
+        SourceRedshifts     Optional list of source redshifts, e.g.
+                            [1.0, 1.4, 2.0], to make p(kappa) and p(mu) for
+                            all of them from the same realisations,
+                            instead of just for SourceRedshift. The
+                            calibration lightcones must have been drilled
+                            with the same SourceRedshifts
 
     OUTPUTS
         stdout        Useful information
@@ -133,15 +139,31 @@ def Magnifier(argv):
     zd = experiment.parameters['StrongLensRedshift']
     zs = experiment.parameters['SourceRedshift']
 
+    # Several sources at once? Then the lightcones go out to the deepest:
+    zsources = experiment.getSourceRedshifts()
+    if len(zsources) > 0:
+        zs = max(zsources)
+    else:
+        zsources = None
+
     # --------------------------------------------------------------------    
     # Load the lightcone pickles
     
     calpickles = []
     Nc = experiment.parameters['NCalibrationLightcones'] * Ncats       ### should be 24
 
-    paths = '%s/*_lightcone.pickle' % (CALIB_DIR)
-    found = glob.glob(paths)
-    if len(found) > 0: calpickles = found
+    # Calibration cones may be in a lightcone store rather than pickles:
+    storename = experiment.getLightconeStoreName()
+    if storename is None:
+        paths = '%s/*_lightcone.pickle' % (CALIB_DIR)
+        found = glob.glob(paths)
+        if len(found) > 0: calpickles = found
+        readLightcone = lambda i: pangloss.readPickle(calpickles[i])
+    else:
+        store = pangloss.LightconeStore(storename)
+        pointings = store.pointings()
+        calpickles = [experiment.getLightconePickleName('simulated',pointing=i) for i in pointings]
+        readLightcone = lambda i: store.read(pointings[i])
 
     print "Magnifier: found the lightcones..."
            
@@ -154,7 +176,12 @@ def Magnifier(argv):
     # --------------------------------------------------------------------
     # Make redshift grid:
 
-    grid = pangloss.Grid(zd,zs,nplanes=100)
+    nplanes = int(experiment.parameters.get('NPlanes',100))
+    spacing = experiment.parameters.get('PlaneSpacing','redshift')
+    if zsources is None:
+        grid = pangloss.makeGrid(zd,zs,nplanes=nplanes,spacing=spacing,folder=CALIB_DIR)
+    else:
+        grid = pangloss.MultiSourceGrid(zd,zsources,nplanes=nplanes,spacing=spacing)
    
     # --------------------------------------------------------------------
     # Read in lightcones from pickles:
@@ -162,9 +189,18 @@ def Magnifier(argv):
     calcones = []
 
     for i in xrange(Nc):         
-       calcones.append(pangloss.readPickle(calpickles[i]))
+       calcones.append(readLightcone(i))
        if i==0: print calpickles[i]
 
+    # Cones drilled for a shallower source are missing galaxies that lens
+    # the deepest one, and would bias its p(mu) low:
+    for i in xrange(len(calcones)):
+       zmax = getattr(calcones[i],'zmax',None)
+       if zmax is not None and zmax-0.2 < zs-1e-6:
+          print "Magnifier: ERROR: lightcone",calpickles[i],"was drilled to z_obs < %.2f," % zmax
+          print "Magnifier: too shallow for a source at zs = %.2f: re-run Drill with this config" % zs
+          return
+
     if DoCal=="False": #must be string type
        calcones=[]
        calpickles=[]
@@ -183,7 +219,7 @@ def Magnifier(argv):
 
     # Sort into lightcones for each field
     for i in xrange(Nc): 
-       lc = pangloss.readPickle(calpickles[i])  
+       lc = readLightcone(i)
        num_galaxies = lc.numberWithin(radius=Rc,cut=[16,22],band=mag,units="arcmin")
        lc_galaxies.append(num_galaxies)   
        # Add to the total number of galaxies
@@ -230,7 +266,7 @@ def Magnifier(argv):
     for j in xrange(Nc):        
 
         # Get lightcone
-        lc = pangloss.readPickle(calpickles[j])
+        lc = readLightcone(j)
 
         # --------------------------------------------------------------------
         # Calculate mu and kappa for all lightcones
@@ -257,8 +293,12 @@ def Magnifier(argv):
         mu_add=lc.combineMus(weakapprox=False)                    
                                                                             
         # Add magnification and convergence to global PDF
-        pmu.append(lc.mu_add_total)
-        pk.append(lc.kappa_add_total)
+        if zsources is None:
+            pmu.append(lc.mu_add_total)
+            pk.append(lc.kappa_add_total)
+        else:
+            pmu.append(lc.mu_add_total_zs)
+            pk.append(lc.kappa_add_total_zs)
 
         if plot_contributions is True:
             kappa_cont[j:,] = lc.findContributions('kappa')   
@@ -278,6 +318,15 @@ def Magnifier(argv):
     # --------------------------------------------------------------------
     # Write PDFs to pickles
                    
+    # (One pair of pickles per source; the rest of this script uses the
+    # deepest.)
+    if zsources is not None:
+        for k in range(len(zsources)):
+            pangloss.writePickle(pk[:,k],CALIB_DIR+"/Pofk_z="+str(zsources[k])+".pickle")
+            pangloss.writePickle(pmu[:,k],CALIB_DIR+"/PofMu_z="+str(zsources[k])+".pickle")
+            print "Magnifier: saved PofMu to "+CALIB_DIR+"/PofMu_z="+str(zsources[k])+".pickle"
+        pk,pmu = pk[:,numpy.argmax(zsources)],pmu[:,numpy.argmax(zsources)]
+
     pangloss.writePickle(pk,CALIB_DIR+"/Pofk_z="+str(zs)+".pickle")
     pangloss.writePickle(pmu,CALIB_DIR+"/PofMu_z="+str(zs)+".pickle")
 
@@ -3,7 +3,7 @@
 
 import pangloss
 
-import sys,getopt,cPickle,numpy
+import os,sys,getopt,cPickle,numpy,itertools,multiprocessing
 
 # ======================================================================
 
@@ -28,8 +28,37 @@ def Reconstruct(argv):
         The number of kappah samples desired must also be given in the
         config file.
 
+        Each lightcone's random draws come from its own stream, seeded
+        by RandomSeed and its pointing number, so the results do not
+        depend on how many processes share the work, or in what order
+        the lightcones are done. If RandomSeed is not given, one is
+        chosen (and printed) at random.
+
+        Long runs can be stopped and restarted. A manifest in the
+        CalibrationFolder records the configuration and seed, and a log
+        next to it lists the lightcones that are done, with the size and
+        modification time of their pickles (or LightconeStore shards). A
+        restarted run with the same configuration skips them (and re-uses
+        the seed, if RandomSeed is not given), unless their lightcones
+        have changed since, eg by re-running Drill. If CheckpointRealisations
+        is set, each lightcone's samples so far are also saved every that
+        many realisations, along with the state of its random number
+        stream, so that a partly finished lightcone carries on where it
+        stopped, with the same samples as if it had not. All outputs are
+        written to temporary files and then moved into place.
+
+        If ProfileTable is True, the halo profile functions are
+        interpolated from a table, built once per run, rather than
+        evaluated for every galaxy in every realisation. The table's
+        maximum relative error is printed when it is built.
+
+        NPlanes and PlaneSpacing set the redshift planes (100, evenly
+        spaced in redshift, by default); see Grid.
+
     FLAGS
         -h            Print this message [0]
+        -j, --jobs N  Reconstruct lightcones with N processes [1]
+        -f, --fresh   Ignore any earlier progress, and start again [0]
 
     INPUTS
         configfile    Plain text file containing Pangloss configuration
@@ -41,6 +70,8 @@ def Reconstruct(argv):
     EXAMPLE
         Reconstruct.py example.config
 
+        Reconstruct.py --jobs 64 example.config
+
     BUGS
         - Code is incomplete.
 
@@ -56,16 +87,23 @@ def Reconstruct(argv):
     # --------------------------------------------------------------------
 
     try:
-       opts, args = getopt.getopt(argv,"h",["help"])
+       opts, args = getopt.getopt(argv,"hj:f",["help","jobs=","fresh"])
     except getopt.GetoptError, err:
        print str(err) # will print something like "option -a not recognized"
        print Reconstruct.__doc__  # will print the big comment above.
        return
 
+    jobs = 1
+    fresh = False
     for o,a in opts:
        if o in ("-h", "--help"):
           print Reconstruct.__doc__
           return
+       elif o in ("-j", "--jobs"):
+          jobs = int(a)
+          assert jobs > 0, "need at least one job"
+       elif o in ("-f", "--fresh"):
+          fresh = True
        else:
           assert False, "unhandled option"
 
@@ -86,9 +124,6 @@ def Reconstruct(argv):
     
     experiment = pangloss.Configuration(configfile)
 
-    # Get the experiment name from the configfile name instead?
-    EXP_NAME = experiment.parameters['ExperimentName']
-
     zd = experiment.parameters['StrongLensRedshift']
     zs = experiment.parameters['SourceRedshift']
 
@@ -99,158 +134,348 @@ def Reconstruct(argv):
     
     obspickle = experiment.getLightconePickleName('real')
     
-    # Ray tracing:
-    RTscheme = experiment.parameters['RayTracingScheme']
-    
     # SHM relation parameters:
     SHMrelation = experiment.parameters['StellarMass2HaloMassRelation']
     CALIB_DIR = experiment.parameters['CalibrationFolder'][0]
-    SHMfile = CALIB_DIR+'/'+SHMrelation+'.pickle'
     
     # Halo mass function data:
     HMFfile = experiment.parameters['HMFfile'][0]
     
-    # Photo-zs:
-    zperr = experiment.parameters['PhotozError']
-    
-    # Stellar mass observations:
-    MserrP = experiment.parameters['PhotometricMstarError']
-    MserrS = experiment.parameters['SpectroscopicMstarError']
-    # Sampling Pr(kappah|D):
-    Ns = experiment.parameters['NRealisations']
-    
     # Reconstruct calibration lines of sight?
     DoCal = experiment.parameters['ReconstructCalibrations']
 
+    # Every lightcone's random numbers are drawn from RandomSeed and its
+    # pointing number:
+    seed = experiment.parameters.get('RandomSeed')
+
+    # --------------------------------------------------------------------
+    # Pick up the progress of any earlier run of this experiment, as long
+    # as nothing that affects the results has changed since:
+
+    EXP_NAME = experiment.parameters['ExperimentName']
+    manifestfile = CALIB_DIR+'/'+EXP_NAME+'_Reconstruct_manifest.pickle'
+    donefile = CALIB_DIR+'/'+EXP_NAME+'_Reconstruct_done.log'
+
+    manifest,resuming = None,False
+    if not fresh and os.path.exists(manifestfile):
+        manifest = pangloss.readPickle(manifestfile)
+        if manifest['parameters'] != run_parameters(experiment):
+            print "Reconstruct: configuration has changed since the last run, starting again"
+            manifest = None
+        elif seed is not None and int(seed) != manifest['seed']:
+            print "Reconstruct: RandomSeed has changed since the last run, starting again"
+            manifest = None
+
+    if manifest is None:
+        if seed is None:
+            seed = numpy.random.randint(2**31)
+            print "Reconstruct: no RandomSeed given, using",seed
+        manifest = {'parameters':run_parameters(experiment),'seed':int(seed)}
+        pangloss.writePickle(manifest,manifestfile)
+        open(donefile,'w').close()
+        done = {}
+    else:
+        done = read_done(donefile)
+        print "Reconstruct: resuming, with %i lightcones already done" % len(done)
+        resuming = True
+    seed = manifest['seed']
+
     # --------------------------------------------------------------------
     # Load in stellar mass to halo relation, or make a new one:
 
-    try:
-        shmr = pangloss.readPickle('dummy')#SHMfile)
-    except IOError:
+    # (The cache is named after its inputs, so a new HMF gives a new one.)
+
+    shmr = pangloss.SHMR(method=SHMrelation)
+    SHMRcache = shmr.cacheName(CALIB_DIR,HMFfile)
+    if shmr.readCache(SHMRcache):
+        print "Reconstruct: read the stellar mass to halo mass grid from "+SHMRcache
+    else:
         print "Reconstruct: generating the stellar mass to halo mass grid."
         print "Reconstruct: this may take a moment..."
-        shmr = pangloss.SHMR(method=SHMrelation)
         shmr.makeHaloMassFunction(HMFfile)
         shmr.makeCDFs()
-        pangloss.writePickle(shmr,SHMfile)
-        print "Reconstruct: SHMR saved to "+SHMfile
+        shmr.writeCache(SHMRcache)
+        print "Reconstruct: SHMR saved to "+SHMRcache
     
     # --------------------------------------------------------------------
     # Make redshift grid:
     
-    grid = pangloss.Grid(zd,zs,nplanes=100)
+    nplanes = int(experiment.parameters.get('NPlanes',100))
+    spacing = experiment.parameters.get('PlaneSpacing','redshift')
+    grid = pangloss.makeGrid(zd,zs,nplanes=nplanes,spacing=spacing,folder=CALIB_DIR)
+    print "Reconstruct: "+str(grid)
     
     # --------------------------------------------------------------------
-    # Read in lightcones from pickles:
-
-    calcones = []
-    for i in range(Nc):
-        calcones.append(pangloss.readPickle(calpickles[i]))
-    obscone = pangloss.readPickle(obspickle)
+    # Optionally, tabulate the halo profile functions, once for all cones:
 
-    if DoCal=="False": #must be string type
-        calcones=[]
-        calpickles=[]
+    table = None
+    if experiment.parameters.get('ProfileTable','False') in ('True','true'):
+        table = pangloss.ProfileTable("BMO1")
+        print "Reconstruct: using",table
 
-    allcones = calcones+[obscone]
-    allconefiles = calpickles+[obspickle]
+    # --------------------------------------------------------------------
+    # List the lightcones to be reconstructed. They are read in one at a
+    # time, by whichever process reconstructs them; the observed cone
+    # has pointing -1:
+
+    tasks = []
+    if DoCal != "False": #must be string type
+        for i in range(Nc):
+            tasks.append((calpickles[i],i,seed,i==0))
+    tasks.append((obspickle,-1,seed,True))
+
+    # Skip the lightcones that are done, unless they have been re-drilled
+    # since, and throw away the checkpoints of any that were left
+    # unfinished by an earlier run that we are not resuming:
+    store = None
+    storename = experiment.getLightconeStoreName()
+    if storename is not None:
+        store = pangloss.LightconeStore(storename)
+        if DoCal != "False": store.check()
+    todo,changed = [],0
+    for task in tasks:
+        conefile,pointing = task[0],task[1]
+        identity = cone_identity(conefile,pointing,store)
+        pfile,previous = done.get(pointing,(None,None))
+        if pfile is not None and os.path.exists(pfile):
+            if previous == identity: continue
+            changed += 1
+        if not resuming:
+            pangloss.rm(checkpoint_name(kappa_pdf_name(conefile,EXP_NAME)))
+        todo.append(task+(identity,))
+    tasks = todo
+    if changed > 0:
+        print "Reconstruct: %i lightcones have changed since they were done, redoing them" % changed
 
     # --------------------------------------------------------------------
     # Make realisations of each lightcone, and store sample kappah vals:
 
-    for i in range(len(allcones)):
+    if jobs > 1:
+        print "Reconstruct: Sharing %i lightcones between %i processes..." % (len(tasks),jobs)
+        pool = multiprocessing.Pool(jobs,initializer=setup_worker,
+                                    initargs=(experiment,grid,shmr,table))
+        done = pool.imap_unordered(reconstruct_cone,tasks)
+    else:
+        setup_worker(experiment,grid,shmr,table)
+        done = itertools.imap(reconstruct_cone,tasks)
 
-        print pangloss.dashedline
-        print "Reconstruct: drawing %i samples from Pr(kappah|D)" % (Ns)
-        print "Reconstruct:   given data in "+allconefiles[i]
+    # Log each lightcone as soon as it is finished:
+    count = 0
+    for pointing,pfile,identity in done:
+        record_done(donefile,pointing,pfile,identity)
+        count += 1
 
-        # Get lightcone, and start PDF for its kappa_halo:
-        lc = allcones[i]
-        p = pangloss.PDF('kappa_halo')
-        # coming soon: gamma1, gamma2...
+    if jobs > 1:
+        pool.close()
+        pool.join()
+
+    print "Reconstruct: All %i lightcones reconstructed." % count
 
-        # Redshift scaffolding:
-        lc.defineSystem(zd,zs)
-        lc.loadGrid(grid)
-
-        # Figure out data quality etc:
-        lc.configureForSurvey(experiment)
-
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
-
-        # Draw Ns sample realisations of this lightcone, and hence
-        # accumulate samples from Pr(kappah|D):
-        for j in range(Ns):
-
-            if j % 20 == 0 and j !=0:
-                print ("Reconstruct: ...on sample %i out of %i..." % (j,Ns))
-
-            # Draw z from z_obs:
-            lc.mimicPhotozError(sigma=zperr)
-            lc.snapToGrid(grid)
-            
-            # Simulated lightcones need mock observed Mstar_obs values 
-            # drawing from their Mhalos:
-            if lc.flavor == 'simulated': lc.drawMstars(shmr)
-            
-            # Draw Mstar from Mstar_obs:
-            lc.mimicMstarError(sigmaP=MserrP,sigmaS=MserrS)
-
-            # Draw Mhalo from Mstar, and then c from Mhalo:
-            lc.drawMhalos(shmr)
-            lc.drawConcentrations(errors=True)
-
-            # Compute each halo's contribution to the convergence:
-            lc.makeKappas(truncationscale=10)
-            
-            k_add=lc.combineKappas()
-
-            if RTscheme == 'sum':
-                p.append([lc.kappa_add_total])
-                # coming soon: lc.gamma1_add_total, lc.gamma2_add_total
-            elif RTscheme == 'keeton':
-                p.append([lc.kappa_keeton])
-            else:
-                raise "Unknown ray-tracing scheme: "+RTscheme
-            
-            # Make a nice visualisation of one of the realisations, in
-            # two example cases:
-            if j ==0 and (lc.flavor == 'real' or i == 0):
-                x = allconefiles[i]
-                pngfile = x.split('.')[0]+".png"
-                lc.plot(output=pngfile)
-                print "Reconstruct: saved visualisation of lightcone in "+pngfile
-        
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
-
-
-
-        # Take Hilbert ray-traced kappa for this lightcone as "truth":
-        p.truth[0] = lc.kappa_hilbert
-        
-        # Pickle this lightcone's PDF:
-        x = allconefiles[i]
-        pfile = x.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_PofKappah.pickle"
-        pangloss.writePickle(p,pfile)
-
-        print "Reconstruct: Pr(kappah|D) saved to "+pfile
-        
-        # To save loading in time in Calibrate.py we compute the median
-        # of kappah and save it in a separate file, with kappaHilbert
-        if lc.flavor=="simulated":
-            pfile2 = x.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_KappaHilbert_Kappah_median.pickle"
-            pangloss.writePickle([p.truth[0],[numpy.median(p.samples)]],pfile2)
-
-            # BUG: shouldn't Pr(kappa,<kappah>) be pickled as a PDF?
-            # BUG: and named appropriately? 
-            # No, this is just a pair of values
-
-        #print numpy.median(p.samples)
     # --------------------------------------------------------------------
     print pangloss.doubledashedline
     return
 
+# ======================================================================
+# Each process needs the experiment, grid, SHMR and profile table (if any),
+# but gets them only once (in --jobs mode, this runs when the worker
+# process starts):
+
+worker = {}
+
+def setup_worker(experiment,grid,shmr,table=None):
+    worker.clear()
+    worker.update(experiment=experiment,grid=grid,shmr=shmr,table=table)
+    storename = experiment.getLightconeStoreName()
+    if storename is not None:
+        worker['store'] = pangloss.LightconeStore(storename)
+    return
+
+# ======================================================================
+# Reconstruct one lightcone, and pickle its Pr(kappah|D). The random number
+# stream is seeded from the experiment seed and the cone's pointing number,
+# so the samples are the same whichever process draws them. Returns the
+# pointing number, the name of the pickle, and the identity of the cone
+# it came from.
+
+def reconstruct_cone(task):
+
+    conefile,pointing,seed,plot,identity = task
+
+    experiment = worker['experiment']
+    grid,shmr = worker['grid'],worker['shmr']
+
+    EXP_NAME = experiment.parameters['ExperimentName']
+    zd = experiment.parameters['StrongLensRedshift']
+    zs = experiment.parameters['SourceRedshift']
+    RTscheme = experiment.parameters['RayTracingScheme']
+    zperr = experiment.parameters['PhotozError']
+    MserrP = experiment.parameters['PhotometricMstarError']
+    MserrS = experiment.parameters['SpectroscopicMstarError']
+    Ns = experiment.parameters['NRealisations']
+
+    # Save progress every this many realisations (or only at the end):
+    interval = int(experiment.parameters.get('CheckpointRealisations',0))
+    if interval <= 0: interval = Ns
+
+    pfile = kappa_pdf_name(conefile,EXP_NAME)
+    checkpointfile = checkpoint_name(pfile)
+
+    print pangloss.dashedline
+    print "Reconstruct: drawing %i samples from Pr(kappah|D)" % (Ns)
+    print "Reconstruct:   given data in "+conefile
+
+    # Get lightcone (calibration cones may be in a lightcone store rather
+    # than pickles):
+    if pointing >= 0 and 'store' in worker:
+        lc = worker['store'].read(pointing)
+    else:
+        lc = pangloss.readPickle(conefile)
+
+    # Start PDF for its kappa_halo, or carry on from a checkpoint left by
+    # an earlier run, with the random number stream as it was then:
+    checkpoint = None
+    if os.path.exists(checkpointfile):
+        checkpoint = pangloss.readPickle(checkpointfile)
+        if checkpoint['parameters'] != run_parameters(experiment) or \
+                checkpoint['seed'] != seed or checkpoint.get('cone') != identity:
+            checkpoint = None
+    if checkpoint is None:
+        p = pangloss.PDF('kappa_halo')
+        # coming soon: gamma1, gamma2...
+        done = 0
+        numpy.random.seed([seed,pointing+1])
+    else:
+        p = checkpoint['pdf']
+        done = checkpoint['done']
+        numpy.random.set_state(checkpoint['random'])
+        print "Reconstruct:   resuming after %i samples" % done
+
+    # Redshift scaffolding:
+    lc.defineSystem(zd,zs)
+    lc.loadGrid(grid)
+
+    # Figure out data quality etc:
+    lc.configureForSurvey(experiment)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    # Draw Ns sample realisations of this lightcone, all at once (or
+    # interval at a time, with a checkpoint after each batch), and
+    # hence accumulate samples from Pr(kappah|D). Simulated lightcones
+    # get mock observed Mstar_obs values drawn from their Mhalos; then
+    # Mstar is drawn from Mstar_obs, Mhalo from Mstar, c from Mhalo,
+    # and finally each halo's contribution to the convergence:
+    first = True
+    while done < Ns:
+        n = min(interval,Ns-done)
+        totals = lc.drawRealisations(n,grid,shmr,zperr,MserrP,MserrS,truncationscale=10,table=worker['table'])
+
+        if RTscheme == 'sum':
+            p.extend(totals['kappa_add'])
+            # coming soon: gamma1_add, gamma2_add
+        elif RTscheme == 'keeton':
+            p.extend(totals['kappa_keeton'])
+        else:
+            raise "Unknown ray-tracing scheme: "+RTscheme
+        done += n
+
+        # Make a nice visualisation of the first realisation (drawn by
+        # this run), in two example cases:
+        if plot and first:
+            pngfile = conefile.split('.')[0]+".png"
+            lc.plot(output=pngfile)
+            print "Reconstruct: saved visualisation of lightcone in "+pngfile
+        first = False
+
+        if done < Ns:
+            checkpoint = {'parameters':run_parameters(experiment),'seed':seed,
+                          'cone':identity,'pdf':p,'done':done,
+                          'random':numpy.random.get_state()}
+            pangloss.writePickle(checkpoint,checkpointfile)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    # Take Hilbert ray-traced kappa for this lightcone as "truth":
+    p.truth[0] = lc.kappa_hilbert
+    
+    # Pickle this lightcone's PDF, and drop its checkpoint:
+    pangloss.writePickle(p,pfile)
+    pangloss.rm(checkpointfile)
+
+    print "Reconstruct: Pr(kappah|D) saved to "+pfile
+    
+    # To save loading in time in Calibrate.py we compute the median
+    # of kappah and save it in a separate file, with kappaHilbert
+    if lc.flavor=="simulated":
+        pfile2 = conefile.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_KappaHilbert_Kappah_median.pickle"
+        pangloss.writePickle([p.truth[0],[numpy.median(p.samples)]],pfile2)
+
+        # BUG: shouldn't Pr(kappa,<kappah>) be pickled as a PDF?
+        # BUG: and named appropriately? 
+        # No, this is just a pair of values
+
+    return pointing,pfile,identity
+
+# ======================================================================
+# Output file names, for a lightcone and its unfinished samples:
+
+def kappa_pdf_name(conefile,EXP_NAME):
+    return conefile.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_PofKappah.pickle"
+
+def checkpoint_name(pfile):
+    return pfile.split('.pickle')[0]+"_checkpoint.pickle"
+
+# ======================================================================
+# A lightcone is identified by the size and modification time of its
+# pickle, or of the LightconeStore shard holding it, so that a cone that
+# Drill has replaced no longer matches the record of the one that was
+# reconstructed. (None if there is no such file.)
+
+def cone_identity(conefile,pointing,store=None):
+    if pointing >= 0 and store is not None and pointing in store:
+        conefile = store.filename(pointing)
+    try:
+        info = os.stat(conefile)
+    except OSError:
+        return None
+    return (info.st_size,info.st_mtime)
+
+# Finished lightcones are appended to a log, one line each, rather than
+# re-writing the whole manifest after every cone. A line cut short by an
+# interrupted run is ignored, and later lines win:
+
+def record_done(donefile,pointing,pfile,identity):
+    size,mtime = identity if identity is not None else (-1,-1.)
+    F = open(donefile,'a')
+    F.write('%i %i %r %s\n' % (pointing,size,mtime,pfile))
+    F.close()
+    return
+
+def read_done(donefile):
+    done = {}
+    if not os.path.exists(donefile): return done
+    F = open(donefile)
+    for line in F:
+        words = line.split(None,3)
+        if not line.endswith('\n') or len(words) < 4: continue
+        identity = (int(words[1]),float(words[2]))
+        if identity == (-1,-1.): identity = None
+        done[int(words[0])] = (words[3].rstrip('\n'),identity)
+    F.close()
+    return done
+
+# ======================================================================
+# The configuration that a run's results depend on, to check that earlier
+# progress can be re-used. Which cones are reconstructed, whether they
+# have been re-drilled (MakeNewCalibrations or not), and the seed, are
+# dealt with separately:
+
+def run_parameters(experiment):
+    ignore = ['NCalibrationLightcones','ReconstructCalibrations',
+              'MakeNewCalibrations','RandomSeed']
+    return dict((key,value) for key,value in experiment.parameters.items()
+                if key not in ignore)
+
 # ======================================================================
 
 if __name__ == '__main__': 
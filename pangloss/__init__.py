@@ -1,6 +1,11 @@
 from lightcone import *
+from galaxies import *
+from skyindex import *
+from lightconestore import *
 from kappamap import *
 from grid import *
+from cosmogrid import *
+from multisourcegrid import *
 from pdf import *
 from shmr import *
 
@@ -8,6 +13,7 @@ from config import *
 from io import *
 
 from lensing import *
+from profiletable import *
 from scalingrelations import *
 
 # Matt Auger's classes.
@@ -1,5 +1,7 @@
 # ===========================================================================
 
+import pangloss
+
 import os, glob
 
 # ======================================================================
@@ -27,6 +29,12 @@ class Configuration(object):
         
         getLightconePickleName(self,flavor,pointing=None): 
 
+        getLightconeStoreName(self): calibration cone store, if used
+
+        getCatalogColumns(self): catalog columns the pipeline needs
+
+        getSourceRedshifts(self): extra source redshifts, if any
+
     BUGS
 
     AUTHORS
@@ -156,6 +164,57 @@ class Configuration(object):
 
         return
 
+    # ------------------------------------------------------------------
+    # Calibration lightcones can be kept in a single LightconeStore in
+    # the CALIB_DIR, instead of one pickle each:
+
+    def getLightconeStoreName(self):
+
+        if self.parameters.get('LightconeStore','False') not in ('True','true'):
+            return None
+
+        CALIB_DIR = self.parameters['CalibrationFolder'][0]
+        return CALIB_DIR+"/lightcones"
+
+    # ------------------------------------------------------------------
+    # List the catalog columns that the rest of the pipeline uses, by
+    # their names in the catalog files as well as their standard names, so
+    # that readCatalog can skip the rest. Projection is opt-in, since any
+    # other columns are then missing from the lightcones: returns None (all
+    # columns) unless ProjectCatalogColumns is True.
+
+    def getCatalogColumns(self):
+
+        if self.parameters.get('ProjectCatalogColumns','False') not in ('True','true'):
+            return None
+
+        columns = ['nRA','Dec','z_obs','Mhalo_obs','Mstar_obs','Type']
+        namekeys = ['nRAName','DecName','CalibMhaloName','CalibRedshiftName',
+                    'ObsMstarName','ObsRedshiftName','MagName']
+        for key in namekeys:
+            if key in self.parameters: columns.append(self.parameters[key])
+
+        # The survey selection band:
+        band = self.parameters.get('LightconeDepthBand')
+        if band is not None:
+            columns.append(pangloss.magnitudeColumn(band))
+
+        return columns
+
+    # ------------------------------------------------------------------
+    # Magnifier can work with several sources at once, listed in
+    # SourceRedshifts as eg [1.0,1.4,2.0]. Returns the list of floats,
+    # which is empty if the key is missing or blank. Drilling has to reach
+    # the deepest of these and SourceRedshift.
+
+    def getSourceRedshifts(self):
+
+        zsources = str(self.parameters.get('SourceRedshifts',''))
+        zsources = zsources.split('[')[-1].split(']')[0].strip()
+        if zsources == '': return []
+
+        return [float(z) for z in zsources.split(',')]
+
 
 # ======================================================================
 
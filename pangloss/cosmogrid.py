@@ -0,0 +1,137 @@
+# ===========================================================================
+
+import pangloss
+
+import numpy
+import distances
+
+# ============================================================================
+
+class CosmoGrid(pangloss.Grid):
+    """
+    NAME
+        CosmoGrid
+
+    PURPOSE
+        A redshift Grid whose plane quantities are computed for a whole
+        batch of cosmologies at once, so that lightcone realisations can
+        each be given a different cosmology, and kappa_ext marginalised
+        over the cosmological parameters.
+
+    COMMENTS
+        The planes are the same as in a Grid with the same zl, zs and
+        nplanes, and snap works in the same way. Da_p, Da_ps, Da_pl,
+        rho_crit, sigma_crit and beta are (Ncosmo x Nplanes) arrays,
+        and Da_l, Da_s and Da_ls have length Ncosmo. The comoving
+        distances to every plane, the lens and the source are integrated
+        for all the cosmologies together, with Gauss-Legendre quadrature
+        between consecutive redshifts, so the whole batch costs about as
+        much as a single Grid. Only w = -1 is supported. The galaxies of
+        realisation i, snapped to planes p, use row cosmology[i] of the
+        plane arrays: see Lightcone.drawRealisations.
+
+        drawRealisations is the only way to use a CosmoGrid: the
+        step-by-step Lightcone methods (snapToGrid, makeKappas and so on)
+        need one value per plane, and snapToGrid refuses a CosmoGrid.
+        Nothing in Reconstruct or the configuration file makes one yet.
+
+    INITIALISATION
+        zl            Strong lens redshift (needed for critical densities etc)
+        zs            Source plane redshift
+        nplanes       Number of redshift planes in grid (def=100)
+        cosmologies   Ncosmo x 3 array of [Om,Ol,h]
+                        (def: [[0.25,0.75,0.73]])
+        spacing       Plane spacing, as for Grid (def: "redshift"); the
+                        planes are placed in the first cosmology
+
+    METHODS
+        snap(self,z): Return redshift of nearest plane to z
+
+        Da(self,D1,D2,z2): angular diameter distances between redshifts
+          whose comoving distances are D1 and D2, for all cosmologies
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,zl,zs,nplanes=100,cosmologies=[[0.25,0.75,0.73]],spacing="redshift"):
+
+        assert zs > zl
+
+        self.name = 'Redshift grid of lens planes, with precalculated quantities for many cosmologies'
+        self.cosmologies = numpy.atleast_2d(numpy.array(cosmologies,dtype=numpy.float64))
+        self.Ncosmo = len(self.cosmologies)
+
+        # The planes are the same in every cosmology:
+        self.cosmo = list(self.cosmologies[0])
+        D = None
+        if spacing != "redshift":
+            D = distances.Distance(self.cosmo)
+            D.tabulate(zmax=max(10.,zs))
+        self.makePlanes(zl,zs,nplanes,spacing,D)
+
+        # Each parameter as an Ncosmo x 1 column, to broadcast over planes:
+        Om,Ol,h = [self.cosmologies[:,k:k+1] for k in range(3)]
+        self.Ok = 1.-Om-Ol
+        self.Dh = (distances.c/h)/1e5
+
+        # Comoving distances (in units of c/H0) from z=0 to the planes, the
+        # lens and the source, integrated interval by interval:
+        z = numpy.concatenate((self.redshifts,[zl,zs]))
+        order = numpy.argsort(z)
+        edges = numpy.concatenate(([0.],z[order]))
+        dz = numpy.diff(edges)
+        xg,wg = numpy.polynomial.legendre.leggauss(8)
+        zg = edges[:-1,numpy.newaxis] + 0.5*dz[:,numpy.newaxis]*(1.+xg)
+        f = distances.Distance().integrand()
+        E = f(zg,Om[:,:,numpy.newaxis],Ol[:,:,numpy.newaxis],self.Ok[:,:,numpy.newaxis])
+        Dc = numpy.empty((self.Ncosmo,len(z)))
+        Dc[:,order] = numpy.cumsum(0.5*dz*numpy.dot(E,wg),axis=1)
+        Dc_p,Dc_l,Dc_s = Dc[:,:self.nz],Dc[:,-2:-1],Dc[:,-1:]
+
+        zp = self.redshifts
+        self.Da_l = self.Da(0.,Dc_l,zl)
+        self.Da_s = self.Da(0.,Dc_s,zs)
+        self.Da_ls = self.Da(Dc_l,Dc_s,zs)
+        self.Da_p = self.Da(0.,Dc_p,zp)
+        self.Da_ps = self.Da(Dc_p,Dc_s,numpy.maximum(zp,zs))
+        self.Da_pl = self.Da(Dc_p,Dc_l,numpy.maximum(zp,zl))
+        self.sigma_crit,self.beta = self.weights(self.Da_p,self.Da_ps,self.Da_pl,
+                                                 self.Da_l,self.Da_s,self.Da_ls)
+        self.Da_l,self.Da_s,self.Da_ls = self.Da_l[:,0],self.Da_s[:,0],self.Da_ls[:,0]
+
+        # (Distance's critical density formula broadcasts over cosmologies.)
+        self.rho_crit = distances.Distance([Om,Ol,h]).rho_crit_univ(zp)
+
+        self.plane = {}
+
+        return
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return pangloss.Grid.__str__(self)+', for %i cosmologies' % self.Ncosmo
+
+# ----------------------------------------------------------------------------
+# Angular diameter distance (Mpc) between redshifts z1 < z2, given their
+# comoving distances in units of c/H0, in each cosmology:
+
+    def Da(self,D1,D2,z2):
+        dc = numpy.abs(D2-D1)
+        k = numpy.sqrt(numpy.abs(self.Ok))
+        old = numpy.seterr(divide='ignore',invalid='ignore')
+        dm = numpy.where(self.Ok > 0,numpy.sinh(k*dc)/k,
+             numpy.where(self.Ok < 0,numpy.sin(k*dc)/k,dc))
+        numpy.seterr(**old)
+        return self.Dh*dm/(1.+z2)
+
+# ============================================================================
@@ -5,6 +5,15 @@ A module to compute cosmological distances, including:
     luminosity_distance (Dl)
     comoving_volume (volume)
 
+Call tabulate() to integrate 1/E(z) once, onto a table of the cumulative
+comoving distance, and answer Dc, Dm, Da, Dl (and Da(z1,z2)) for numpy
+arrays of redshifts by interpolation. The interpolation is cubic Hermite,
+using the exact derivative 1/E(z) at the table nodes, so with the default
+spacing dz=0.01 the relative error is below 1e-8 (worst in the first
+cells, where Dc is smallest). The maximum relative error in Dc, measured
+at a sample of cell midpoints, is kept in tableerror. Redshifts
+beyond the table are integrated as before.
+
 """
 c = 299792458.
 G = 4.3e-6
@@ -28,18 +37,21 @@ class Distance:
         self.Dl = self.luminosity_distance
         self.dm = self.distance_modulus
         self.volume = self.comoving_volume
+        self.table = None
 
 
     def set(self,cosmo):
         self.OMEGA_M = cosmo[0]
         self.OMEGA_L = cosmo[1]
         self.h = cosmo[2]
+        self.retabulate()
 
     def reset(self):
         self.OMEGA_M = 0.3
         self.OMEGA_L = 0.7
         self.h = 0.7
         self.w = -1.
+        self.retabulate()
 
     def age(self,z):
         from scipy import integrate
@@ -49,10 +61,8 @@ class Distance:
         ok = 1.-om-ol
         return (9.778/self.h)*integrate.romberg(f,1e-300,1/(1.+z),(om,ol,ok))
 
-    def comoving_distance(self,z1,z2=0.):
+    def integrand(self):
         from scipy import integrate
-        if z2<z1:
-            z1,z2 = z2,z1
         def fa(z):
             if self.w_analytic==True:
                 return self.w(z,self.wpars)
@@ -66,6 +76,15 @@ class Distance:
             f = lambda z,m,l,k : (m*(1.+z)**3.+k*(1.+z)**2.+l*(1.+z)**(3.*(1.+self.w)))**-0.5
         else:
             f = lambda z,m,l,k : (m*(1.+z)**3.+k*(1.+z)**2.+l)**-0.5
+        return f
+
+    def comoving_distance(self,z1,z2=0.):
+        if self.table is not None:
+            return self.tabulated_comoving_distance(z1,z2)
+        from scipy import integrate
+        if z2<z1:
+            z1,z2 = z2,z1
+        f = self.integrand()
         om = self.OMEGA_M
         ol = self.OMEGA_L
         ok = 1.-om-ol
@@ -76,18 +95,18 @@ class Distance:
         dc = 1e5*self.comoving_distance(z1,z2)/(c/self.h)
         ok = 1.-self.OMEGA_M-self.OMEGA_L
         if ok>0:
-            from math import sinh,sqrt
-            dtc = sinh(sqrt(ok)*dc)/sqrt(ok)
+            dtc = numpy.sinh(numpy.sqrt(ok)*dc)/numpy.sqrt(ok)
         elif ok<0:
-            from math import sin,sqrt
             ok *= -1.
-            dtc = sin(sqrt(ok)*dc)/sqrt(ok)
+            dtc = numpy.sin(numpy.sqrt(ok)*dc)/numpy.sqrt(ok)
         else:
             dtc = dc
         return (c/self.h)*dtc/1e5
 
     def angular_diameter_distance(self,z1,z2=0.):
-        if z2<z1:
+        if self.table is not None:
+            z1,z2 = numpy.minimum(z1,z2),numpy.maximum(z1,z2)
+        elif z2<z1:
             z1,z2 = z2,z1
         return self.comoving_transverse_distance(z1,z2)/(1.+z2)
 
@@ -105,8 +124,63 @@ class Distance:
         return solidangle*4*pi*(c/self.h)*integrate.romberg(f,z1,z2,(om,ol,ok))/1e5
 
     def distance_modulus(self,z):
-        from math import log10
-        return 5*log10(self.luminosity_distance(z)*1e5)
+        return 5*numpy.log10(self.luminosity_distance(z)*1e5)
+
+# ----------------------------------------------------------------------------
+# Tabulated distances: D[i] is the comoving distance (in units of c/H0) from
+# z=0 to z=i*dz, integrated cell by cell with Gauss-Legendre quadrature.
+# (Re-tabulate after changing w, which set() cannot see.)
+
+    def tabulate(self,zmax=10.,dz=0.01):
+        from scipy import integrate
+        self.table = None
+        n = int(numpy.ceil(zmax/dz))
+        z = dz*numpy.arange(n+1)
+        f = self.integrand()
+        if self.w_analytic or callable(self.w):
+            f = numpy.vectorize(f)
+        om = self.OMEGA_M
+        ol = self.OMEGA_L
+        ok = 1.-om-ol
+        xg,wg = numpy.polynomial.legendre.leggauss(8)
+        zg = z[:-1,numpy.newaxis] + 0.5*dz*(1.+xg)
+        cells = 0.5*dz*numpy.dot(f(zg,om,ol,ok),wg)
+        D = numpy.concatenate(([0.],numpy.cumsum(cells)))
+        self.table = {'zmax':z[-1],'dz':dz,'D':D,'dDdz':f(z,om,ol,ok)}
+
+        # Check against quad, at the middle of a sample of cells:
+        zc = z[numpy.linspace(0,n-1,50).astype(int)] + 0.5*dz
+        exact = numpy.array([integrate.quad(f,0.,zi,(om,ol,ok),epsabs=0.,epsrel=1e-12)[0] for zi in zc])
+        self.tableerror = numpy.max(numpy.abs(self.D_table(zc)/exact-1.))
+        return
+
+    def retabulate(self):
+        if self.table is not None:
+            self.tabulate(self.table['zmax'],self.table['dz'])
+        return
+
+    def D_table(self,z):
+        T = self.table
+        u = numpy.asarray(z,dtype=numpy.float64)/T['dz']
+        i = numpy.clip(numpy.floor(u),0,len(T['D'])-2).astype(int)
+        t = u - i
+        D0,D1 = T['D'][i],T['D'][i+1]
+        m0,m1 = T['dDdz'][i]*T['dz'],T['dDdz'][i+1]*T['dz']
+        return D0 + t*(m0 + t*((3.*(D1-D0)-2.*m0-m1) + t*(2.*(D0-D1)+m0+m1)))
+
+    def tabulated_comoving_distance(self,z1,z2=0.):
+        scalar = (numpy.ndim(z1) == 0 and numpy.ndim(z2) == 0)
+        z1,z2 = numpy.broadcast_arrays(numpy.atleast_1d(numpy.asarray(z1,dtype=numpy.float64)),
+                                       numpy.atleast_1d(numpy.asarray(z2,dtype=numpy.float64)))
+        dc = numpy.abs(self.D_table(z2) - self.D_table(z1))
+        outside = (numpy.maximum(z1,z2) > self.table['zmax']) | (numpy.minimum(z1,z2) < 0.)
+        if outside.any():
+            table,self.table = self.table,None
+            dc[outside] = 1e5*numpy.vectorize(self.comoving_distance)(z1[outside],z2[outside])/(c/self.h)
+            self.table = table
+        dc = (c/self.h)*dc/1e5
+        if scalar: dc = dc[0]
+        return dc
 
 
 # ============================================================================
@@ -123,3 +197,38 @@ class Distance:
     def rho_crit_univ(self,z):   #critical density of the universe at z
        rho= (2.642*10**46)*self.Hsquared(z) #units of solar mass per cubic megaparsec, H(z) must be in units of per second.
        return rho 
+
+# ============================================================================
+
+if __name__ == '__main__':
+
+    print "Testing Distance.tabulate..."
+
+    z = numpy.concatenate(([0.001,0.005],numpy.random.RandomState(21).uniform(0.,10.,200)))
+
+    for cosmo in ([0.25,0.75,0.73],[0.3,0.6,0.7],[0.3,0.8,0.7]):
+        exact = Distance(cosmo)
+        D = Distance(cosmo)
+        D.tabulate()
+        assert D.tableerror < 1e-8
+
+        # Array queries agree with quad, to the quoted accuracy:
+        Dc = numpy.array([exact.Dc(zi) for zi in z])
+        assert numpy.max(numpy.abs(D.Dc(z)/Dc-1.)) < 1e-8
+        Da = numpy.array([exact.Da(zi) for zi in z])
+        assert numpy.max(numpy.abs(D.Da(z)/Da-1.)) < 1e-8
+        Dl = numpy.array([exact.Dl(zi) for zi in z])
+        assert numpy.max(numpy.abs(D.Dl(z)/Dl-1.)) < 1e-8
+        Da12 = numpy.array([exact.Da(0.5,zi) for zi in z[z > 0.6]])
+        assert numpy.max(numpy.abs(D.Da(0.5,z[z > 0.6])/Da12-1.)) < 1e-8
+
+        # Either order of the redshifts, as before:
+        assert D.Da(2.,0.5) == D.Da(0.5,2.)
+
+        # Scalars give scalars, and redshifts beyond the table use quad:
+        assert numpy.ndim(D.Dc(1.)) == 0
+        assert abs(D.Dc(12.)/exact.Dc(12.)-1.) < 1e-12
+
+    print "...done."
+
+# ============================================================================
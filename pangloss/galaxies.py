@@ -0,0 +1,237 @@
+# ===========================================================================
+
+import pangloss
+
+import numpy
+
+# ============================================================================
+
+class Galaxies(object):
+    """
+    NAME
+        Galaxies
+
+    PURPOSE
+        Hold the galaxy catalog of a Lightcone as a set of separate,
+        contiguous numpy column arrays, with just enough of the atpy
+        Table interface for the rest of Pangloss to use it unchanged.
+
+    COMMENTS
+        An atpy Table keeps its columns in one structured array, so that
+        every add_column rebuilds the whole table, and every where() copies
+        all of it. Here each column is its own array: adding a column
+        allocates just that column, and over-writing one (as writeColumn
+        does, every realisation) copies the new values into the existing
+        buffer. Selections (where, rows) gather each column with one index
+        array, into a new, compact Galaxies. Columns are available as
+        attributes (galaxies.z) or items (galaxies['z']), and are the
+        arrays themselves, so galaxies.spec_flag[i] = True works in place.
+        io.readCatalog returns whole catalogs as Galaxies too, sharing
+        the memory-mapped columns of its binary cache (copy=False).
+
+    INITIALISATION
+        catalog       atpy Table, numpy structured array, Galaxies, or
+                        anything else with keys(), to take columns from
+        rows          Optional row numbers (or mask) to take from catalog
+        copy          If False, and there are no rows, share the catalog's
+                        column arrays instead of copying them (def=True)
+
+    METHODS
+        keys(self): column names, in order
+
+        add_column(self,name,values,copy=True): new column (ValueError if
+          it exists); scalar values are broadcast to all rows
+
+        rename_column(self,old,new): KeyError if there is no column old
+
+        where(self,mask): new Galaxies with just the rows in mask
+
+        rows(self,indices): new Galaxies with just the given rows
+
+        data: the whole catalog as one numpy structured array (a copy)
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started
+    """
+
+    __slots__ = ('names','columns','N')
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,catalog=None,rows=None,copy=True):
+
+        self.names = []
+        self.columns = {}
+        self.N = 0
+
+        if catalog is None: return
+
+        if isinstance(catalog,numpy.ndarray):
+            names = catalog.dtype.names
+        else:
+            names = catalog.keys()
+
+        for name in names:
+            values = numpy.asarray(catalog[name])
+            if rows is None:
+                if copy: values = numpy.array(values)
+            else:
+                values = values[rows]
+            self.names.append(name)
+            self.columns[name] = values
+        if len(self.names) > 0:
+            self.N = len(self.columns[self.names[0]])
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Galaxies: %i rows of %i columns' % (self.N,len(self.names))
+
+    def __len__(self):
+        return self.N
+
+    def __contains__(self,name):
+        return name in self.columns
+
+    def keys(self):
+        return tuple(self.names)
+
+# ----------------------------------------------------------------------------
+# Column access, by attribute or by item. Setting an existing column copies
+# into its buffer, with its type, as atpy does:
+
+    def __getattr__(self,name):
+        # (Slots are unset while unpickling, so don't look for them here.)
+        if name in Galaxies.__slots__: raise AttributeError(name)
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self,name):
+        return self.columns[name]
+
+    def __setitem__(self,name,values):
+        if name in self.columns:
+            self.columns[name][...] = values
+        else:
+            self.add_column(name,values)
+        return
+
+    def add_column(self,name,values,copy=True):
+        if name in self.columns:
+            raise ValueError("column "+name+" already exists")
+        values = numpy.asarray(values)
+        if values.ndim == 0:
+            values = numpy.repeat(values,self.N)
+        elif len(self.names) == 0:
+            self.N = len(values)
+        assert len(values) == self.N, "column "+name+" has the wrong length"
+        self.names.append(name)
+        self.columns[name] = numpy.array(values) if copy else values
+        return
+
+    def rename_column(self,old,new):
+        if new in self.columns:
+            raise ValueError("column "+new+" already exists")
+        self.columns[new] = self.columns.pop(old)
+        self.names[self.names.index(old)] = new
+        return
+
+# ----------------------------------------------------------------------------
+# Selections return new, compact catalogs:
+
+    def where(self,mask):
+        return Galaxies(self,numpy.where(mask)[0])
+
+    def rows(self,indices):
+        return Galaxies(self,numpy.asarray(indices,dtype=int))
+
+# ----------------------------------------------------------------------------
+
+    def _data(self):
+        dtype = numpy.dtype([(name,self.columns[name].dtype) for name in self.names])
+        data = numpy.empty(self.N,dtype=dtype)
+        for name in self.names:
+            data[name] = self.columns[name]
+        return data
+
+    data = property(_data)
+
+# ----------------------------------------------------------------------------
+# Slots are not pickled by the older pickle protocols, so say what to keep:
+
+    def __getstate__(self):
+        return (self.names,self.columns,self.N)
+
+    def __setstate__(self,state):
+        self.names,self.columns,self.N = state
+        return
+
+# ============================================================================
+
+if __name__ == '__main__':
+
+    import cPickle
+
+    print "Testing Galaxies..."
+
+    z = numpy.array([0.1,0.5,0.9,1.3])
+    galaxies = Galaxies({'z':z,'Mh':numpy.array([11.,12.,13.,14.])})
+    assert len(galaxies) == 4 and galaxies.keys() == ('z','Mh')
+
+    # Columns are copies of the catalog's, available as items or
+    # attributes, and setting one writes into it, with its type:
+    assert galaxies['z'] is galaxies.z and galaxies.z is not z
+    galaxies['Mh'] = [1,2,3,4]
+    assert galaxies.Mh.dtype == numpy.float64
+    assert (galaxies.Mh == [1.,2.,3.,4.]).all()
+    galaxies.z[0] = 0.2
+    assert z[0] == 0.1 and galaxies.z[0] == 0.2
+
+    # New columns, by add_column or setitem, with scalars broadcast:
+    galaxies.add_column('spec_flag',False)
+    assert (galaxies.spec_flag == False).all() and len(galaxies.spec_flag) == 4
+    galaxies['r'] = numpy.arange(4.)
+    assert galaxies.keys() == ('z','Mh','spec_flag','r')
+    try:
+        galaxies.add_column('z',z)
+        assert False, "add_column over-wrote an existing column"
+    except ValueError:
+        pass
+
+    # Selections are new, compact catalogs, in the order asked for:
+    sub = galaxies.rows([3,1])
+    assert len(sub) == 2 and (sub.r == [3.,1.]).all()
+    sub.r[0] = -1.
+    assert galaxies.r[3] == 3.
+    sub = galaxies.where(galaxies.z > 0.6)
+    assert (sub.Mh == [3.,4.]).all() and sub.keys() == galaxies.keys()
+
+    # The whole catalog as a structured array, and back:
+    data = galaxies.data
+    assert data.dtype.names == galaxies.keys()
+    again = Galaxies(data)
+    for name in galaxies.keys():
+        assert (again[name] == galaxies[name]).all()
+
+    # Pickling, with every protocol:
+    for protocol in (0,2):
+        again = cPickle.loads(cPickle.dumps(galaxies,protocol))
+        assert again.keys() == galaxies.keys() and len(again) == len(galaxies)
+        for name in galaxies.keys():
+            assert (again[name] == galaxies[name]).all()
+            assert again[name].dtype == galaxies[name].dtype
+
+    print "...done."
+
+# ============================================================================
@@ -2,7 +2,7 @@
 
 import pangloss
 
-import os,cPickle,atpy
+import os,cPickle,atpy,numpy,shutil,itertools,collections
 
 # ======================================================================
 
@@ -16,16 +16,40 @@ import os,cPickle,atpy
     COMMENTS
 
     FUNCTIONS
-        writePickle(contents,filename):
+        writePickle(contents,filename): written to a temporary file, and
+                                      then moved into place, so that the
+                                      file is never left half-written
 
         readPickle(filename): returns contents of pickle
 
-        readCatalog(filename,config): returns table, given column names
-                                      in configuration config
+        readCatalog(filename,config,cache=True): returns Galaxies of
+                                      just the columns needed, given column
+                                      names in configuration config
+
+        readCatalogChunks(filename,config,chunksize=1000000,cache=True):
+                                      yields the same Galaxies, a chunk of
+                                      rows at a time
+
+        makeCatalogCache(filename,config,chunksize=1000000): makes the
+                                      binary column cache that
+                                      readCatalogChunks streams from
+
+        makeColumns(names,columns): returns Galaxies sharing the named
+                                      arrays
+
+        writeArrays(columns,folder,info=None): one .npy file per array
+
+        readArrays(folder,names=None,mmap=True): returns names, dictionary
+                                      of (memory-mapped) arrays, and info;
+                                      mmap can also be a numpy mmap_mode
 
         rm(filename): silent file removal
 
     BUGS
+        - readCatalogChunks takes its column types from the first chunk of
+          an ASCII catalog, so text columns can be truncated in later ones.
+        - readCatalogChunks needs the column names on the first line of an
+          ASCII catalog, and raises ValueError if they are not there.
 
     AUTHORS
       This file is part of the Pangloss project, distributed under the
@@ -39,9 +63,11 @@ import os,cPickle,atpy
 #=========================================================================
 
 def writePickle(contents,filename):
-    F = open(filename,"wb")
+    tmp = filename+'.tmp%i' % os.getpid()
+    F = open(tmp,"wb")
     cPickle.dump(contents,F,protocol=2)
     F.close()
+    os.rename(tmp,filename)
     return
 
 def readPickle(filename):
@@ -52,12 +78,12 @@ def readPickle(filename):
 
 # ----------------------------------------------------------------------------
 
-def readCatalog(filename,config):
+def readCatalog(filename,config,cache=True):
 
 # PJM: we need to switch to astropy tables...
 # Here's how Richard McMahon uses them, admittedly when reading in FITS:
 
-"""
+    """
 here is an example; I like to write out the version number to help with debugging.
 
 import astropy
@@ -85,7 +111,31 @@ table.write('new.fits')
 
 """
 
-    table = atpy.Table(filename, type='ascii')
+    # Only parse the columns the configuration says are needed:
+    include = config.getCatalogColumns()
+
+    # Parsing a large ASCII catalog is slow, so keep a binary copy of its
+    # columns alongside it, and re-use that whenever the file is unchanged.
+    # The cached columns are memory-mapped, so each is only read from disk
+    # when (and where) it is used:
+    table = None
+    if cache:
+        table = readCatalogCache(filename,include)
+    if table is None:
+        if include is None:
+            table = atpy.Table(filename, type='ascii')
+        else:
+            table = atpy.Table(filename, type='ascii', include_names=include)
+        if cache:
+            writeCatalogCache(table,filename,include)
+        table = makeColumns(table.keys(),table)
+
+    return prepareCatalog(table,config)
+
+# ----------------------------------------------------------------------------
+# Give catalog columns their standard names, as set in the configuration:
+
+def prepareCatalog(table,config):
 
     try: table.rename_column(config.parameters['nRAName'],'nRA')
     except: pass
@@ -105,12 +155,272 @@ table.write('new.fits')
     except: pass
     try:
         mag = table[config.parameters['MagName']]
-        table.add_column('mag',mag)
+        table.add_column('mag',mag,copy=False)
     except:
         raise "Error in io.readCatalog: no mag column called "+config.parameters['MagName']
 
     return table
 
+# ----------------------------------------------------------------------------
+# Read a catalog that may not fit in memory, as a series of tables of at most
+# chunksize rows each, in catalog order. Chunks come from the binary column
+# cache, which is memory-mapped, so only one chunk is ever held in memory;
+# if there is no cache yet, one is made by parsing the ASCII catalog a chunk
+# at a time too. An empty catalog gives one empty chunk.
+
+def readCatalogChunks(filename,config,chunksize=1000000,cache=True):
+
+    include = config.getCatalogColumns()
+
+    cached = None
+    if cache:
+        cached = makeCatalogCache(filename,config,chunksize)
+
+    if cached is None:
+        chunks = parseCatalogChunks(filename,chunksize,include)
+    else:
+        names,columns = cached
+        N = len(columns[names[0]])
+        chunks = ((names,dict((name,columns[name][i:i+chunksize]) for name in names))
+                  for i in range(0,max(N,1),chunksize))
+
+    for chunknames,chunk in chunks:
+        yield prepareCatalog(makeColumns(chunknames,chunk),config)
+
+    return
+
+# ----------------------------------------------------------------------------
+# Make sure a catalog has a binary column cache, parsing it a chunk at a
+# time if need be, and return the cached (names,columns), or None if the
+# cache could not be written. Several processes streaming the same catalog
+# must not all try to make its cache at once, so call this first, in one
+# process (as Drill does before starting its workers).
+
+def makeCatalogCache(filename,config,chunksize=1000000):
+
+    include = config.getCatalogColumns()
+
+    cached = openCatalogCache(filename,include)
+    if cached is None:
+        writeCatalogCacheChunks(filename,chunksize,include)
+        cached = openCatalogCache(filename,include)
+
+    return cached
+
+# ----------------------------------------------------------------------------
+# Parse an ASCII catalog (one header line of column names, then one row per
+# line) chunksize rows at a time, yielding the names and a dictionary of
+# column arrays for each chunk. Column types are set by the first chunk.
+# Only the columns named in include are parsed, unless it is None. An empty
+# catalog yields one empty chunk, so that callers still see its columns.
+#
+# The header must be the first line that is not blank, with or without a
+# leading '#'. The atpy ASCII reader used by readCatalog guesses at other
+# layouts too (comment lines before the header, no header at all); rather
+# than mis-read those, they are rejected here, with a ValueError.
+
+def parseCatalogChunks(filename,chunksize,include=None):
+
+    F = open(filename)
+    header,first = readCatalogHeader(F,filename)
+    usecols = [i for i,name in enumerate(header) if include is None or name in include]
+    if len(usecols) == 0:
+        F.close()
+        raise ValueError("io.parseCatalogChunks: none of the columns "+str(include)+" are in "+filename)
+    names = [header[i] for i in usecols]
+    dtype = None
+    rows = itertools.chain(first,F)
+    while True:
+        lines = [line for line in itertools.islice(rows,chunksize) if isCatalogRow(line)]
+        if len(lines) == 0: break
+        data = numpy.atleast_1d(numpy.genfromtxt(lines,dtype=dtype,usecols=usecols))
+        dtype = data.dtype
+        if dtype.names is None:
+            # Columns all of one type (or just one column) come back as a
+            # plain array, rather than a structured one:
+            data = data.reshape(len(lines),len(names))
+            yield names,dict((name,data[:,i]) for i,name in enumerate(names))
+        else:
+            yield names,dict((name,data[field]) for name,field in zip(names,dtype.names))
+    F.close()
+
+    if dtype is None:
+        yield names,dict((name,numpy.zeros(0)) for name in names)
+
+    return
+
+def isCatalogRow(line):
+    line = line.strip()
+    return len(line) > 0 and line[0] != '#'
+
+# Read the header line of an ASCII catalog, and check it against the first
+# row of data, which is returned (in a list, empty if there is none) so that
+# it can still be parsed:
+
+def readCatalogHeader(F,filename):
+
+    header = None
+    for line in F:
+        if line.strip():
+            header = line.lstrip('#').split()
+            break
+    if header is None:
+        raise ValueError("io.readCatalogHeader: "+filename+" is empty")
+
+    first = []
+    for line in F:
+        if isCatalogRow(line):
+            first = [line]
+            break
+
+    def isnumber(word):
+        try: float(word)
+        except ValueError: return False
+        return True
+
+    problem = None
+    if all(isnumber(name) for name in header):
+        problem = "its first line is data, not column names"
+    elif len(first) > 0:
+        row = first[0].split('#')[0].split()
+        if len(row) != len(header):
+            problem = "its first line has %i column names, but its first row of data has %i values" % (len(header),len(row))
+        elif not any(isnumber(value) for value in row):
+            problem = "its first row of data has no numbers in it - is it a second header line?"
+    if problem is not None:
+        raise ValueError("io.readCatalogHeader: cannot stream "+filename+": "+problem+ \
+                         ". Catalogs read in chunks need their column names on the first line; set CatalogChunkSize to 0 to read this one whole.")
+
+    return header,first
+
+# ----------------------------------------------------------------------------
+# Binary column cache for parsed catalogs. The cache is a folder next to
+# the catalog, keyed by the catalog's path, size and modification time.
+# Column renaming happens after reading, so one cache serves any config
+# that needs no columns beyond those it was made with (include, or all the
+# columns if None) - a config that does just causes a re-parse. Columns are
+# memory-mapped copy-on-write, so that callers can convert them in place
+# (as Drill does) without touching the cache.
+
+def catalogCacheName(filename):
+    return filename+'.columns'
+
+def catalogCacheKey(filename):
+    info = os.stat(filename)
+    return '%s:%i:%i' % (os.path.abspath(filename),info.st_size,int(info.st_mtime))
+
+def catalogCacheInfo(filename,include):
+    return {'key':catalogCacheKey(filename),'include':include}
+
+def openCatalogCache(filename,include=None):
+    folder = catalogCacheName(filename)
+    try:
+        names,columns,info = readArrays(folder,mmap='c')
+    except IOError:
+        return None
+    if not isinstance(info,dict) or info['key'] != catalogCacheKey(filename):
+        return None
+    if include is None:
+        if info['include'] is not None: return None
+    else:
+        if info['include'] is not None and not set(include) <= set(info['include']): return None
+        names = [name for name in names if name in include]
+    return names,columns
+
+def readCatalogCache(filename,include=None):
+    cached = openCatalogCache(filename,include)
+    if cached is None:
+        return None
+    return makeColumns(*cached)
+
+def writeCatalogCache(table,filename,include=None):
+    columns = [(name,table[name]) for name in table.keys()]
+    try:
+        writeArrays(columns,catalogCacheName(filename),info=catalogCacheInfo(filename,include))
+    except (IOError,OSError), err:
+        print "io.readCatalog: could not cache catalog columns: "+str(err)
+    return
+
+# Fill the cache from the ASCII catalog a chunk at a time, straight into
+# memory-mapped .npy files, so that the whole catalog is never in memory:
+
+def writeCatalogCacheChunks(filename,chunksize,include=None):
+    folder = catalogCacheName(filename)
+    tmp = folder+'.tmp%i' % os.getpid()
+    try:
+        F = open(filename)
+        header,first = readCatalogHeader(F,filename)
+        N = len(first) + sum(1 for line in F if isCatalogRow(line))
+        F.close()
+
+        shutil.rmtree(tmp,ignore_errors=True)
+        os.makedirs(tmp)
+        names,arrays,start = None,None,0
+        for names,columns in parseCatalogChunks(filename,chunksize,include):
+            if arrays is None:
+                arrays = [numpy.lib.format.open_memmap(os.path.join(tmp,'%i.npy' % i),
+                              mode='w+',dtype=columns[name].dtype,shape=(N,))
+                          for i,name in enumerate(names)]
+            n = len(columns[names[0]])
+            for array,name in zip(arrays,names):
+                array[start:start+n] = columns[name]
+            start += n
+        if arrays is None:
+            raise IOError("no columns read from "+filename)
+        for array in arrays: array.flush()
+        del arrays
+
+        writePickle({'names':names,'info':catalogCacheInfo(filename,include)},os.path.join(tmp,'index.pickle'))
+        shutil.rmtree(folder,ignore_errors=True)
+        os.rename(tmp,folder)
+    except (IOError,OSError), err:
+        print "io.readCatalogChunks: could not cache catalog columns: "+str(err)
+        shutil.rmtree(tmp,ignore_errors=True)
+    return
+
+# ----------------------------------------------------------------------------
+# Wrap named columns (a dictionary of arrays, an atpy table or a numpy
+# structured array) in a Galaxies catalog without copying them, so that
+# memory-mapped columns stay on disk until used. Galaxies.data gives a
+# structured array of the whole catalog, if one is needed.
+
+def makeColumns(names,columns):
+    return pangloss.Galaxies(collections.OrderedDict((name,columns[name]) for name in names),copy=False)
+
+# ----------------------------------------------------------------------------
+# Store named arrays as one .npy file each, in a folder, so that they can be
+# memory-mapped back in individually. Column names can contain characters
+# that are not allowed in filenames, so the files are numbered, and the
+# names kept in an index pickle along with any info supplied. The folder is
+# written under a temporary name and then moved into place, so readers never
+# see a partly written store.
+
+def writeArrays(columns,folder,info=None):
+    tmp = folder+'.tmp%i' % os.getpid()
+    shutil.rmtree(tmp,ignore_errors=True)
+    os.makedirs(tmp)
+    names = []
+    for i,(name,values) in enumerate(columns):
+        numpy.save(os.path.join(tmp,'%i.npy' % i),numpy.asarray(values))
+        names.append(name)
+    writePickle({'names':names,'info':info},os.path.join(tmp,'index.pickle'))
+    shutil.rmtree(folder,ignore_errors=True)
+    os.rename(tmp,folder)
+    return
+
+def readArrays(folder,names=None,mmap=True):
+    index = readPickle(os.path.join(folder,'index.pickle'))
+    if names is None: names = index['names']
+    if mmap in ('r','r+','c'):
+        mode = mmap
+    else:
+        mode = 'r' if mmap else None
+    arrays = {}
+    for name in names:
+        i = index['names'].index(name)
+        arrays[name] = numpy.load(os.path.join(folder,'%i.npy' % i),mmap_mode=mode)
+    return names,arrays,index['info']
+
 # ----------------------------------------------------------------------------
 # Remove file, if it exists, stay quiet otherwise:
 
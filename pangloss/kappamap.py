@@ -1,6 +1,6 @@
 
 import numpy, os, string
-import struct, pyfits
+import pyfits
 import cPickle
 
 arcmin2rad = (1.0/60.0)*numpy.pi/180.0
@@ -23,6 +23,8 @@ class Kappamap:
     COMMENTS
         A "physical" coordinate system is used, where x = -RA (rad) 
         and y = Dec (rad). This is the system favoured by Hilbert et al.
+        Maps are memory-mapped rather than read in, so that only the
+        pages actually looked up are ever loaded from disk.
 
     INITIALISATION
         kappafile      Name of file containing a convergence map
@@ -47,7 +49,8 @@ class Kappamap:
 
         world2image(self,a,d): coord transformation, returns a,d
 
-        at(self,x,y,coordinate_system='physical'): return pixel values
+        at(self,x,y,coordinate_system='physical'): return pixel values,
+          for scalar positions or whole arrays of them
 
         lookup(self,i,j): return pixel values given image coords
 
@@ -108,7 +111,7 @@ class Kappamap:
 # ----------------------------------------------------------------------------
 
     def read_in_fits_data(self):
-        hdu = pyfits.open(self.input)[0]
+        hdu = pyfits.open(self.input,memmap=True)[0]
         hdr = hdu.header
         self.get_fits_wcs(hdr)
         self.values = hdu.data
@@ -123,13 +126,9 @@ class Kappamap:
 # ----------------------------------------------------------------------------
 
     def read_in_binary_data(self):
-        file = open(self.input,"rb")
-        data = file.read()
-        fmt = str(self.NX*self.NX)+'f'
-        start = 0
-        stop = struct.calcsize(fmt)
-        values = struct.unpack(fmt,data[start:stop])
-        self.values = numpy.array(values,dtype=numpy.float32).reshape(self.NX,self.NX)
+        # Hilbert's maps are just NX*NX native float32s, so view the file
+        # directly as an array:
+        self.values = numpy.memmap(self.input,dtype=numpy.float32,mode='r',shape=(self.NX,self.NX))
         return None
 
 # ----------------------------------------------------------------------------
@@ -236,7 +235,7 @@ class Kappamap:
      # Only approximate WCS transformations - assumes dec=0.0 and small field
     def image2world(self,i,j):
         a = self.wcs['CRVAL1'] + self.wcs['CD1_1']*(i - self.wcs['CRPIX1'])
-        if a < 0.0: a += 360.0
+        a = a + 360.0*(a < 0.0)
         d = self.wcs['CRVAL2'] + self.wcs['CD2_2']*(j - self.wcs['CRPIX2'])
         return a,d
 
@@ -250,20 +249,25 @@ class Kappamap:
     def lookup(self,i,j):
       
         # Weighted mean of 4 neighbouring pixels, as suggested by Stefan.
-        ix = int(i)
-        iy = int(j)
+        # i and j can be scalars or arrays; points off the map get zero.
+        i = numpy.asarray(i,dtype=numpy.float64)
+        j = numpy.asarray(j,dtype=numpy.float64)
+        ix = numpy.trunc(i).astype(int)
+        iy = numpy.trunc(j).astype(int)
         px = i - ix
         py = j - iy
 
-        if ((0 <= ix) and (ix < self.NX-1) and (0 <= iy) and (iy < self.NX-1)):
-            mean =   self.values[ix,iy]    *(1.0-px)*(1.0-py) \
-                  + self.values[ix+1,iy]  * px     *(1.0-py) \
-                  + self.values[ix,iy+1]  *(1.0-px)* py      \
-                  + self.values[ix+1,iy+1]* px     * py
-        else:
-            mean = 0.0        
+        inside = (0 <= ix) & (ix < self.NX-1) & (0 <= iy) & (iy < self.NX-1)
+        ix = numpy.where(inside,ix,0)
+        iy = numpy.where(inside,iy,0)
+
+        mean =   self.values[ix,iy]    *(1.0-px)*(1.0-py) \
+              + self.values[ix+1,iy]  * px     *(1.0-py) \
+              + self.values[ix,iy+1]  *(1.0-px)* py      \
+              + self.values[ix+1,iy+1]* px     * py
+        mean = numpy.where(inside,mean,0.0)
 
-        return mean
+        return mean[()]
       
 # ============================================================================
 
@@ -320,12 +324,10 @@ if __name__ == '__main__':
         kappa = numpy.zeros((l/U,l/U,len(kappafiles)))
         print numpy.shape(kappa)
 
+        i,j = numpy.meshgrid(U*numpy.arange(l/U),U*numpy.arange(l/U),indexing='ij')
         for k in range(len(kappafiles)):
            convergence = Kappamap(kappafiles[k],FITS=False)
-           for i in range(l/U):
-              if i % 500 ==0 : print k,",",i
-              for j in range(l/U):
-                 kappa[i,j,k] = convergence.at(U*i,U*j,coordinate_system='image')
+           kappa[:,:,k] = convergence.at(i,j,coordinate_system='image')
 
         kappa=kappa.ravel()
 
@@ -28,6 +28,8 @@ from scipy.special import gamma,gammainc # for Sersic profile.
             BMO1Gfunc(x,t):
             BMO2Ffunc(x,t):
             BMO2Gfunc(x,t):
+            BMO1FGfunc(x,t,Fout=None,Gout=None):
+            BMO2FGfunc(x,t,Fout=None,Gout=None):
         Sersic profile:
             sersic(r,re,amp=1.,n=4.):
 
@@ -70,19 +72,16 @@ def F2(x):
 # Function needed to calculate kappa for an NFW halo. 
 
 def Ffunc(x):
-    z=numpy.zeros(len(x))
-    for i in range(len(x)):
-       if x[i]==-1:
-           z[i]=0.0
-       elif x[i]>1:
-          z[i]= (1-(2./(x[i]**2-1)**.5)*numpy.arctan(((x[i]-1.)/(x[i]+1))**.5))/(x[i]**2-1.)
-       else: 
-          if x[i]==1:
-             z[i] =1./3
-          else:
-             y=(-x[i]**2+1)**.5
-             z[i] = (1.-(2./(1-x[i]**2)**.5)*numpy.arctanh(((1.-x[i])/(x[i]+1))**.5))/(x[i]**2-1)
-       if z[i] < 0: print 'warning Ffunc' # BUG - non-informative alert
+    x = numpy.asarray(x,dtype=numpy.float64)
+    z = numpy.zeros(len(x))
+    hi = (x > 1)
+    lo = (x < 1) & (x != -1)
+    X = x[hi]
+    z[hi] = (1-(2./(X**2-1)**.5)*numpy.arctan(((X-1.)/(X+1))**.5))/(X**2-1.)
+    X = x[lo]
+    z[lo] = (1.-(2./(1-X**2)**.5)*numpy.arctanh(((1.-X)/(X+1))**.5))/(X**2-1)
+    z[x==1] = 1./3
+    if numpy.any(z < 0): print 'warning Ffunc: negative at x =',x[z < 0]
     return 2*z
     
 # ------------------------------------------------------------------------
@@ -90,25 +89,24 @@ def Ffunc(x):
 # Form is  long, but follows http://arxiv.org/pdf/astro-ph/9908213v1.pdf
 
 def Gfunc(x): 
-    z=numpy.zeros(len(x))
-    for i in range(len(x)):
-        X=x[i]
-        if x[i]>1:
-            y=(((X-1)/(X+1))**.5)
-            z[i]= (8* numpy.arctan(y) / (X**2*(X**2-1)**0.5)) +\
-                (4/X**2)*numpy.log(X/2) - \
-                2/(X**2-1) +\
-                4*numpy.arctan(y)/(((X**2)-1)**(3./2))
-        else: 
-            if x[i]==1:
-                z[i] =(10./3+4*numpy.log(0.5))
-            else:
-                y=(((1-X)/(X+1))**.5)
-                z[i]= (8* numpy.arctanh(y) / (X**2*(1-X**2)**0.5)) +\
-                    (4/X**2)*numpy.log(X/2) - \
-                    2/(X**2-1) +\
-                    4*numpy.arctanh(y)/((X**2-1)*(1-X**2)**(1./2))
-        if z[i]<0: print 'warning Gfunc'; print x[i]; print z[i]
+    x = numpy.asarray(x,dtype=numpy.float64)
+    z = numpy.zeros(len(x))
+    hi = (x > 1)
+    lo = (x < 1)
+    X = x[hi]
+    y = (((X-1)/(X+1))**.5)
+    z[hi] = (8* numpy.arctan(y) / (X**2*(X**2-1)**0.5)) +\
+        (4/X**2)*numpy.log(X/2) - \
+        2/(X**2-1) +\
+        4*numpy.arctan(y)/(((X**2)-1)**(3./2))
+    X = x[lo]
+    y = (((1-X)/(X+1))**.5)
+    z[lo] = (8* numpy.arctanh(y) / (X**2*(1-X**2)**0.5)) +\
+        (4/X**2)*numpy.log(X/2) - \
+        2/(X**2-1) +\
+        4*numpy.arctanh(y)/((X**2-1)*(1-X**2)**(1./2))
+    z[x==1] = (10./3+4*numpy.log(0.5))
+    if numpy.any(z < 0): print 'warning Gfunc: negative at x =',x[z < 0]
     return z
 
 # ========================================================================
@@ -186,6 +184,93 @@ def BMO2Gfunc(x,t):
         )
     return 4*z/(x**2)
 
+# ------------------------------------------------------------------------
+# Fused versions of the above, returning both F and G from one pass: the
+# shared intermediates (the NFW F(x), L(x,t), sqrt(t^2+x^2)) are computed
+# once, the caller's x is left alone, and the results are written into
+# Fout and Gout if they are given. x and t are 1D arrays (or t a scalar).
+
+def BMO1FGfunc(x,t,Fout=None,Gout=None):
+    x,t2,s,f,L = BMOintermediates(x,t)
+    x2 = x**2
+
+    # Common prefactor, and the truncation term:
+    a = t2/(t2+1)**2
+    b = (t2-1)*L
+    b /= t
+
+    # F = 2a*( (t2+1)(1-f)/(x2-1) + 2f - (pi-b)/s ):
+    kappa = (t2+1)*(1-f)
+    kappa /= (x2-1)
+    kappa += 2*f
+    kappa -= (3.14159-b)/s
+    Fout = numpy.multiply(2*a,kappa,out=Fout)
+
+    # G = 4a*( (t2+1+2(x2-1))f + t pi + (t2-1)log(t) + s(b-pi) )/x2:
+    kbar = (t2+1+2*(x2-1))*f
+    kbar += t*3.14159 + (t2-1)*numpy.log(t)
+    b -= 3.14159
+    b *= s
+    kbar += b
+    kbar /= x2
+    Gout = numpy.multiply(4*a,kbar,out=Gout)
+
+    return Fout,Gout
+
+# ------------------------------------------------------------------------
+
+def BMO2FGfunc(x,t,Fout=None,Gout=None):
+    x,t2,s,f,L = BMOintermediates(x,t)
+    x2 = x**2
+    s2 = s**2
+    s3 = s2*s
+    t4 = t2**2
+    t3 = t2*t
+
+    # Coefficient of L shared by F and G:
+    c = s2*(3*t4-6*t2-1)
+
+    # F = (t4/(t2+1)^3)*( ... ):
+    kappa = 2*(t2+1)*(1-f)
+    kappa /= (x2-1)
+    kappa += 8*f
+    kappa += (t4-1)/(t2*s2)
+    kappa -= 3.14159*(4*s2+t2+1)/s3
+    kappa += (t2*(t4-1)+c)*L/(t3*s3)
+    Fout = numpy.multiply(t4/(t2+1)**3,kappa,out=Fout)
+
+    # G = (2 t4/(t2+1)^3)*( ... )/x2:
+    kbar = (t2+1+4*(x2-1))*(2*f)
+    kbar += (3.14159*(3*t2-1)+2*t*(t2-3)*numpy.log(t))/t
+    kbar -= 3.14159*(4*s2-t2-1)/s
+    kbar += (c-t2*(t4-1))*L
+    kbar /= x2
+    Gout = numpy.multiply(2*t4/(t2+1)**3,kbar,out=Gout)
+
+    return Fout,Gout
+
+# ------------------------------------------------------------------------
+# Intermediates shared by the fused BMO functions. As in BMO1Ffunc etc, x=1
+# is moved to 1+1e-5 (but in a copy), and F(x) is the NFW function F above:
+
+def BMOintermediates(x,t):
+    x = numpy.where(x == 1,1.+1e-5,x)
+    t = numpy.asarray(t,dtype=numpy.float64)
+    t2 = t**2
+    s = numpy.sqrt(t2+x**2)
+
+    f = numpy.empty(len(x))
+    hi = (x > 1)
+    X = x[hi]
+    f[hi] = numpy.arccos(1/X)/((X**2-1)**.5)
+    lo = ~hi
+    X = x[lo]
+    f[lo] = numpy.arccosh(1/X)/((1-X**2)**.5)
+
+    L = numpy.log(x/(s+t))
+
+    return x,t2,s,f,L
+
 # ========================================================================
 # de Vaucelour profile functions.
 
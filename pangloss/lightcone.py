@@ -8,6 +8,26 @@ import pylab as plt
 from math import pi
 
 
+# ======================================================================
+# Given a dictionary of derived quantities and their inputs, list everything
+# downstream of each input:
+
+def downstream(derivations):
+    dependents = {}
+    for name,inputs in derivations.items():
+        for column in inputs:
+            dependents.setdefault(column,set()).add(name)
+    changed = True
+    while changed:
+        changed = False
+        for column,names in dependents.items():
+            for name in list(names):
+                extra = dependents.get(name,set()) - names
+                if extra:
+                    names |= extra
+                    changed = True
+    return dict((column,tuple(sorted(names))) for column,names in dependents.items())
+
 # ======================================================================
 
 class Lightcone(object):
@@ -32,6 +52,13 @@ class Lightcone(object):
         radius        The radius of the lightcone field of view (arcmin)
         maglimit      The depth of the galaxy selection (magnitudes)
         band          The band in which the selection is made
+        zmax          Optional redshift limit: galaxies with z_obs >= zmax
+                        are left out
+        index         Optional SkyIndex over the catalog, to avoid
+                        scanning the whole table for every cone
+        rows          Optional catalog row numbers of the cone members,
+                        if already known (see drillLightcones and
+                        drillLightconesFromChunks below)
     
     METHODS
         galaxiesWithin(self,radius,cut=[18.5,24.5],band="F814W",radius_unit="arcsec"):
@@ -44,7 +71,14 @@ class Lightcone(object):
         
         mimicPhotozError(self,sigma=0.1):
         
-        writeColumn(self,string,values):
+        writeColumn(self,string,values,rows=None): rows, if given, are
+          the only ones to over-write
+        
+        staleRows(self,name): rows of a derived column whose inputs have
+          changed since it was last written (used by the step-by-step
+          methods below, as in Magnifier; drawRealisations recomputes
+          everything for each block, apart from snapping the
+          spectroscopic galaxies once)
         
         snapToGrid(self, Grid):
         
@@ -54,10 +88,23 @@ class Lightcone(object):
         
         drawConcentrations(self,errors=False):
         
-        makeKappas(self,errors=False,truncationscale=5,profile="BMO1"):
+        makeKappas(self,errors=False,truncationscale=5,profile="BMO1",table=None):
+          profile is "BMO1" or "BMO2" (truncated), or "NFW"; table is an
+          optional ProfileTable, to interpolate the profile functions
+          instead of evaluating them
         
         combineKappas(self):
 
+        (After loadGrid with a MultiSourceGrid, makeKappas, combineKappas
+          and combineMus also give arrays of kappa, gamma and mu for each
+          of its sources, as kappa_zs, kappa_add_total_zs, mu_add_total_zs
+          and so on.)
+
+        drawRealisations(self,Ns,grid,model,zperr,sigmaP,sigmaS,...): all
+          of the above, for Ns realisations at once, optionally each in
+          its own cosmology from a CosmoGrid, or for each source in a
+          MultiSourceGrid
+        
     BUGS
 
     AUTHORS
@@ -69,22 +116,48 @@ class Lightcone(object):
       2013-03-23  Collett & Marshall (Cambridge)
     """
 
+# ----------------------------------------------------------------------------
+# Derived galaxy columns, and the columns they are computed from. Writing a
+# column marks the rows that changed as stale in everything downstream of
+# it, so that only those rows need recomputing:
+
+    derivations = {'plane':('z',),
+                   'Da_p':('plane',),'rho_crit':('plane',),
+                   'sigma_crit':('plane',),'beta':('plane',),
+                   'rphys':('Da_p',),
+                   'r200':('Mh','rho_crit'),'c200':('Mh',),
+                   'rs':('r200','c200'),'X':('rphys','rs'),
+                   'kappa_s':('c200','rho_crit','rs','sigma_crit')}
+    dependents = downstream(derivations)
+
+    # Stale rows of each derived column, once it has been written:
+    stale = None
+
 # ----------------------------------------------------------------------------
 
-    def __init__(self,catalog,flavor,position,radius,maglimit=99,band="r"):
+    def __init__(self,catalog,flavor,position,radius,maglimit=99,band="r",zmax=None,index=None,rows=None):
         
         self.name = 'Lightcone through the Universe'
         self.flavor = flavor   # 'real' or 'simulated'
         self.catalog = catalog
+
+        # Selection applied when drilling, kept as a record:
+        self.maglimit = maglimit
+        self.band = band
+        self.zmax = zmax
         
         # Simulated lightcones have "true" (ray-traced) convergence:
         self.kappa_hilbert = None # until set!
         
         # Catalog limits:
-        self.xmax = self.catalog['nRA'].max()
-        self.xmin = self.catalog['nRA'].min()
-        self.ymax = self.catalog['Dec'].max()
-        self.ymin = self.catalog['Dec'].min() 
+        if index is None:
+            self.xmax = self.catalog['nRA'].max()
+            self.xmin = self.catalog['nRA'].min()
+            self.ymax = self.catalog['Dec'].max()
+            self.ymin = self.catalog['Dec'].min() 
+        else:
+            self.xmax,self.xmin = index.xmax,index.xmin
+            self.ymax,self.ymin = index.ymax,index.ymin
         
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
@@ -92,11 +165,20 @@ class Lightcone(object):
         self.rmax = radius
         self.xc = [position[0],position[1]]
 
+        # The cone's galaxies are kept column by column (see Galaxies):
         dx = self.rmax*pangloss.arcmin2rad
-        self.galaxies = self.catalog.where((self.catalog.nRA > (self.xc[0]-dx)) & \
-                                           (self.catalog.nRA < (self.xc[0]+dx)) & \
-                                           (self.catalog.Dec > (self.xc[1]-dx)) & \
-                                           (self.catalog.Dec < (self.xc[1]+dx))   )
+        if rows is not None:
+            # Membership has already been decided, eg by drillLightcones:
+            self.galaxies = pangloss.Galaxies(self.catalog,rows)
+        elif index is None:
+            self.galaxies = pangloss.Galaxies(self.catalog,
+                                              (self.catalog['nRA'] > (self.xc[0]-dx)) & \
+                                              (self.catalog['nRA'] < (self.xc[0]+dx)) & \
+                                              (self.catalog['Dec'] > (self.xc[1]-dx)) & \
+                                              (self.catalog['Dec'] < (self.xc[1]+dx))   )
+        else:
+            # Only the rows in nearby index cells need to be checked:
+            self.galaxies = pangloss.Galaxies(self.catalog,index.query(self.xc,self.rmax))
 
         # Trim it to a circle:
         x = (self.galaxies.nRA - self.xc[0])*pangloss.rad2arcmin
@@ -107,11 +189,19 @@ class Lightcone(object):
         self.galaxies.add_column('y',y)
         self.galaxies.add_column('r',r)
         self.galaxies.add_column('phi',phi)
-        self.galaxies = self.galaxies.where(self.galaxies.r < self.rmax)        
+        if rows is None:
+            self.galaxies = self.galaxies.where(self.galaxies.r < self.rmax)        
         
-        try: 
-            self.galaxies = self.galaxies.where(self.galaxies.Type != 2) 
-        except AttributeError: pass
+            try: 
+                self.galaxies = self.galaxies.where(self.galaxies.Type != 2) 
+            except AttributeError: pass
+
+            # Galaxies too faint or too distant to ever be used:
+            col = magnitudeColumn(band)
+            if maglimit < 99 and col in self.galaxies.keys():
+                self.galaxies = self.galaxies.where(self.galaxies[col] < maglimit)
+            if zmax is not None:
+                self.galaxies = self.galaxies.where(self.galaxies.z_obs < zmax)
                 
         self.allgalaxies = self.galaxies
 
@@ -155,14 +245,7 @@ class Lightcone(object):
 
     def galaxiesWithin(self,radius,cut=[18.5,24.5], band="F814W", radius_unit="arcmin"):
 
-        if band == "u" or band ==  "g" or band == "r" or band ==  "i" or band == "z":
-            col = "mag_SDSS_%s" % band
-        elif band == "F814" or band == "F814W" or band == "814" or band == 814:
-            col = "mag_F814W"
-        elif band == "WFC125" or band == "F125W" or band == "F125" or band == "125" or band == 125:
-            col = "WFC125"
-        else:
-            col = "mag_%s" % band
+        col = magnitudeColumn(band)
         if radius < 0.1: 
             print "Warning: Default units for radius are arcmin!"
         if radius_unit == "arcmin":
@@ -189,6 +272,8 @@ class Lightcone(object):
         self.zl = zl
         self.zs = zs
         self.cosmo = cosmo
+        if getattr(self,'zmax',None) is not None and self.zmax < zs+0.2:
+            print "Lightcone: WARNING: drilled with z_obs < %.2f, not zs+0.2 = %.2f" % (self.zmax,zs+0.2)
         self.galaxies = self.galaxies.where(self.galaxies.z_obs<zs+0.2)
         return
 
@@ -199,6 +284,12 @@ class Lightcone(object):
         if numpy.abs(self.zs-Grid.zs)     > 0.05: print "Grid zs != lens zs" 
         self.redshifts,self.dz = Grid.redshifts,Grid.dz
         self.Da_l,self.Da_s,self.Da_ls = Grid.Da_l,Grid.Da_s,Grid.Da_ls
+        # Lensing weights for each source, from a MultiSourceGrid:
+        self.zsources = getattr(Grid,'zsources',None)
+        if self.zsources is not None:
+            self.sigma_crit_zs,self.beta_zs = Grid.sigma_crit_zs,Grid.beta_zs
+        # Planes from any other grid are no use:
+        self.stale = None
         return
 
 # ----------------------------------------------------------------------------
@@ -216,15 +307,7 @@ class Lightcone(object):
         assert len(SR)==len(SD)
 
         band = experiment.parameters['LightconeDepthBand']
-
-        if band == "u" or band ==  "g" or band == "r" or band ==  "i" or band == "z":
-            col = "mag_SDSS_%s" % band
-        elif band == "F814" or band == "F814W" or band == "814" or band == 814:
-            col = "mag_F814W" #note that this isn't included atm
-        elif band == "WFC125" or band == "F125" or band == "F125W" or band == "125" or band == 125:
-            col = "WFC125" #this was the matching band for BoRG
-        else:
-            col = "mag_%s" % band
+        col = magnitudeColumn(band)
             
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
         # Only include galaxies observed by photometry:
@@ -243,6 +326,7 @@ class Lightcone(object):
                    [_ in goodset for _ in self.galaxies.identifier])]=True
         
         self.galaxies = self.galaxies.where(self.galaxies.photo_flag==True)
+        self.stale = None
 
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
         # Set spectroscopic flag of any galaxy that should have 
@@ -267,13 +351,49 @@ class Lightcone(object):
 # (previous ones are single use per lightcone)
 # ----------------------------------------------------------------------------
 
-# Add galaxy property column, overwriting any values that already exist:
-
-    def writeColumn(self,string,values):
-        try:
+# Add galaxy property column, overwriting any values that already exist
+# (or just those in rows). Changes to a column are passed on to the columns
+# derived from it, as stale rows - the old values are only kept and
+# compared if some derived column is being tracked, so writing columns that
+# nothing has been derived from yet costs no more than before:
+
+    def writeColumn(self,string,values,rows=None):
+        N = len(self.galaxies)
+        if self.stale is None: self.stale = {}
+        tracked = [name for name in Lightcone.dependents.get(string,())
+                   if name in self.stale and len(self.stale[name]) == N]
+        if string not in self.galaxies:
             self.galaxies.add_column('%s'%string,values)
-        except ValueError:
-            self.galaxies["%s"%string]=values
+            changed = True
+        else:
+            column = self.galaxies[string]
+            index = slice(None) if rows is None else rows
+            if len(tracked) > 0: old = column[index].copy()
+            column[index] = values
+            if len(tracked) > 0:
+                changed = numpy.zeros(N,dtype=bool)
+                changed[index] = (column[index] != old)
+        
+        # Keep track of which rows are out of date:
+        if string in Lightcone.derivations:
+            if rows is None or string not in self.stale:
+                self.stale[string] = numpy.zeros(N,dtype=bool)
+            else:
+                self.stale[string][rows] = False
+        for name in tracked:
+            self.stale[name] |= changed
+        return
+
+# ----------------------------------------------------------------------------
+# Rows of a derived column that need (re)computing: all of them, unless
+# the column has been written since the galaxy table was last replaced:
+
+    def staleRows(self,name):
+        N = len(self.galaxies)
+        if self.stale is None or name not in self.stale or \
+                len(self.stale[name]) != N or name not in self.galaxies:
+            return numpy.arange(N)
+        return numpy.where(self.stale[name])[0]
 
 # ----------------------------------------------------------------------------
  
@@ -294,17 +414,26 @@ class Lightcone(object):
         return
 
 # ----------------------------------------------------------------------------
-# Snap the parameters z onto the grid, to speed up calculations:
+# Snap the parameters z onto the grid, to speed up calculations. Only
+# galaxies whose z has changed are re-snapped, and only those that move to
+# another plane get new plane quantities (so spectroscopic galaxies are
+# done once per cone):
 
     def snapToGrid(self, Grid):
-        z = self.galaxies.z
-        sz,p = Grid.snap(z)
-        self.writeColumn('Da_p',Grid.Da_p[p])
-        self.writeColumn('rho_crit',Grid.rho_crit[p])
-        self.writeColumn('sigma_crit',Grid.sigma_crit[p])
-        self.writeColumn('beta',Grid.beta[p])
-        rphys = self.galaxies.r*pangloss.arcmin2rad*self.galaxies.Da_p
-        self.writeColumn('rphys',rphys)
+        if isinstance(Grid,pangloss.CosmoGrid):
+            raise ValueError("Lightcone.snapToGrid: a CosmoGrid can only be used by drawRealisations")
+        rows = self.staleRows('plane')
+        sz,p = Grid.snap(self.galaxies.z[rows])
+        self.writeColumn('plane',p,rows)
+        rows = self.staleRows('Da_p')
+        p = self.galaxies.plane[rows]
+        self.writeColumn('Da_p',Grid.Da_p[p],rows)
+        self.writeColumn('rho_crit',Grid.rho_crit[p],rows)
+        self.writeColumn('sigma_crit',Grid.sigma_crit[p],rows)
+        self.writeColumn('beta',Grid.beta[p],rows)
+        rows = self.staleRows('rphys')
+        rphys = self.galaxies.r[rows]*pangloss.arcmin2rad*self.galaxies.Da_p[rows]
+        self.writeColumn('rphys',rphys,rows)
 # ----------------------------------------------------------------------------
 # Given Mhalo and z, draw an Mstar, and an identical Mstar_obs:
 
@@ -340,44 +469,70 @@ class Lightcone(object):
         return
 
 # ----------------------------------------------------------------------------
-# Given an Mh, what could the halo concentration be?
+# Given an Mh, what could the halo concentration be? With errors, every
+# c200 is drawn afresh; otherwise, as for the other derived columns, only
+# rows whose inputs have changed are recomputed:
 
     def drawConcentrations(self,errors=False):
-        M200 = 10**self.galaxies.Mh        
-        r200 = (3*M200/(800*3.14159*self.galaxies.rho_crit))**(1./3)
-        self.writeColumn("r200",r200)
-        c200 = pangloss.MCrelation(M200,scatter=errors)
-        self.writeColumn("c200",c200)
-        r_s = r200/c200        
-        self.writeColumn('rs',r_s)
-        x = self.galaxies.rphys/r_s
-        self.writeColumn('X',x)
+        rows = self.staleRows('r200')
+        M200 = 10**self.galaxies.Mh[rows]
+        r200 = (3*M200/(800*3.14159*self.galaxies.rho_crit[rows]))**(1./3)
+        self.writeColumn("r200",r200,rows)
+        if errors:
+            c200 = pangloss.MCrelation(10**self.galaxies.Mh,scatter=True)
+            self.writeColumn("c200",c200)
+            # These are not the c200 that Mh alone would give:
+            self.stale['c200'][:] = True
+        else:
+            rows = self.staleRows('c200')
+            c200 = pangloss.MCrelation(10**self.galaxies.Mh[rows])
+            self.writeColumn("c200",c200,rows)
+        rows = self.staleRows('rs')
+        r_s = self.galaxies.r200[rows]/self.galaxies.c200[rows]
+        self.writeColumn('rs',r_s,rows)
+        rows = self.staleRows('X')
+        x = self.galaxies.rphys[rows]/self.galaxies.rs[rows]
+        self.writeColumn('X',x,rows)
         return
 
 # ----------------------------------------------------------------------------
 # Compute halos' contributions to the convergence:
 
-    def makeKappas(self,errors=False,truncationscale=5,profile="BMO1"):
+    def makeKappas(self,errors=False,truncationscale=5,profile="BMO1",table=None):
             
         c200 = self.galaxies.c200
         r200 = self.galaxies.r200
         x = self.galaxies.X
         r_s = self.galaxies.rs
-        rho_s = pangloss.delta_c(c200)*self.galaxies.rho_crit
-        self.kappa_s = rho_s * r_s /self.galaxies.sigma_crit  #kappa slice for each lightcone
+
+        rows = self.staleRows('kappa_s')
+        rho_s = pangloss.delta_c(c200[rows])*self.galaxies.rho_crit[rows]
+        kappa_s = rho_s * r_s[rows] /self.galaxies.sigma_crit[rows]
+        self.writeColumn('kappa_s',kappa_s,rows)
+        self.kappa_s = self.galaxies.kappa_s  #kappa slice for each lightcone
         
         r_trunc = truncationscale*r200
         xtrunc = r_trunc/r_s
         kappaHalo = self.kappa_s*1.0
         gammaHalo = self.kappa_s*1.0
         
-        if profile=="BMO1":
-            F=pangloss.BMO1Ffunc(x,xtrunc)
-            G=pangloss.BMO1Gfunc(x,xtrunc)
+        if table is not None:
+            assert table.profile == profile
+            F,G = table.evaluate(x,xtrunc)
+
+        elif profile=="BMO1":
+            F,G=pangloss.BMO1FGfunc(x,xtrunc)
         
-        if profile=="BMO2":
-            F=pangloss.BMO2Ffunc(x,xtrunc)
-            G=pangloss.BMO2Gfunc(x,xtrunc)
+        elif profile=="BMO2":
+            F,G=pangloss.BMO2FGfunc(x,xtrunc)
+        
+        elif profile=="NFW":
+            # Untruncated: Gfunc is the shear, not the mean convergence.
+            F=pangloss.Ffunc(x)
+            G=F+pangloss.Gfunc(x)
+
+        else:
+            raise ValueError("Unknown profile %s" % profile)
         
         kappaHalo *= F
         gammaHalo *= (G-F)
@@ -395,6 +550,16 @@ class Lightcone(object):
         self.writeColumn('gamma1',-gamma1)
         self.writeColumn('gamma2',-gamma2)
         self.writeColumn('mu',mu)
+
+        # For several sources, only sigma_crit changes: each is an
+        # (Nsources x Ngalaxies) array.
+        if getattr(self,'zsources',None) is not None:
+            w = self.galaxies.sigma_crit/self.sigma_crit_zs[:,self.galaxies.plane]
+            self.kappa_zs = w*kappa
+            self.gamma_zs = w*gamma
+            self.gamma1_zs = -w*gamma1
+            self.gamma2_zs = -w*gamma2
+            self.mu_zs = 1.0/(((1.0 - self.kappa_zs)**2.0) - (self.gamma_zs**2.0))
         
         return
         
@@ -442,8 +607,152 @@ class Lightcone(object):
         self.gamma2_keeton_total=numpy.sum(self.galaxies.gamma2_keeton)
         self.gamma2_tom_total=numpy.sum(self.galaxies.gamma2_tom)
 
+        # Totals for each source, as arrays:
+        if getattr(self,'zsources',None) is not None:
+            B = self.beta_zs[:,self.galaxies.plane]
+            values = combine(B,self.kappa_zs,self.gamma_zs,self.gamma1_zs,self.gamma2_zs)
+            for key,value in values.items():
+                setattr(self,key+'_total_zs',value.sum(axis=1))
+
         return self.kappa_add_total
 
+# ----------------------------------------------------------------------------
+# Draw Ns realisations of the lightcone in one go, as (Ns x Ngal) arrays:
+# the same steps as mimicPhotozError, snapToGrid, drawMstars (simulated
+# cones only), mimicMstarError, drawMhalos, drawConcentrations(errors=True),
+# makeKappas and combineKappas, but paying the Python overhead once per
+# block of realisations instead of once per realisation. Blocks hold about
+# blocksize galaxy-realisations, to bound the memory used. Returns a
+# dictionary of length-Ns arrays of the line of sight totals, keyed by
+# kappa_add, kappa_keeton, kappa_tom and the same for gamma1 and gamma2.
+# The galaxy columns are left as in the first realisation, for plotting.
+# As in makeKappas, table is an optional ProfileTable. If grid is a
+# CosmoGrid, cosmologies gives the (row) number of each realisation's
+# cosmology. If it is a MultiSourceGrid, the totals for each source are
+# returned too, as (Ns x Nsources) arrays keyed by kappa_add_zs etc.
+
+    def drawRealisations(self,Ns,grid,model,zperr,sigmaP,sigmaS,truncationscale=5,profile="BMO1",table=None,blocksize=1000000,cosmologies=None):
+
+        if isinstance(grid,pangloss.CosmoGrid) != (cosmologies is not None):
+            raise ValueError("Lightcone.drawRealisations: cosmologies must be given with a CosmoGrid, and only then")
+
+        N = len(self.galaxies)
+        z_obs = self.galaxies.z_obs
+        spec = (self.galaxies.spec_flag == True)
+        phi = self.galaxies.phi
+        rarcmin = self.galaxies.r
+
+        keys = ['kappa_add','kappa_keeton','kappa_tom',
+                'gamma1_add','gamma1_keeton','gamma1_tom',
+                'gamma2_add','gamma2_keeton','gamma2_tom']
+        totals = dict((key,numpy.zeros(Ns)) for key in keys)
+        zsources = getattr(grid,'zsources',None)
+        if zsources is not None:
+            assert cosmologies is None
+            for key in keys:
+                totals[key+'_zs'] = numpy.zeros((Ns,len(zsources)))
+
+        # Spectroscopic redshifts never change, so those galaxies' planes
+        # are found once, for all realisations:
+        sz,pspec = grid.snap(z_obs[spec])
+
+        nb = max(1,blocksize/max(N,1))
+
+        # Profile function buffers, re-used by every block:
+        Fbuf = numpy.empty(min(nb,Ns)*N)
+        Gbuf = numpy.empty(min(nb,Ns)*N)
+
+        for j in range(0,Ns,nb):
+            n = min(nb,Ns-j)
+
+            # Draw z from z_obs, and snap onto the grid:
+            e = (spec == False)*zperr
+            z = z_obs + e*(1+z_obs)*numpy.random.randn(n,N)
+            p = numpy.empty((n,N),dtype=int)
+            p[:,spec] = pspec
+            p[:,~spec] = grid.snap(z[:,~spec].ravel())[1].reshape(n,-1)
+            planes = p
+            if cosmologies is not None:
+                p = (numpy.asarray(cosmologies)[j:j+n,numpy.newaxis],p)
+            Da_p = grid.Da_p[p]
+            rho_crit = grid.rho_crit[p]
+            sigma_crit = grid.sigma_crit[p]
+            beta = grid.beta[p]
+            rphys = rarcmin*pangloss.arcmin2rad*Da_p
+
+            # Simulated lightcones need mock observed Mstar_obs values,
+            # drawn from their (true) halo masses:
+            if self.flavor == 'simulated':
+                Mh_obs = numpy.tile(self.galaxies.Mh_obs,n)
+                Mstar_obs = model.drawMstars(Mh_obs,z.ravel()).reshape(n,N)
+            else:
+                Mstar_obs = numpy.tile(self.galaxies.Mstar_obs,(n,1))
+
+            # Draw Mstar from Mstar_obs:
+            Mstar = Mstar_obs.copy()
+            Mstar[:,~spec] += numpy.random.randn(n,(~spec).sum())*sigmaP
+            Mstar[:,spec] += numpy.random.randn(n,spec.sum())*sigmaS
+
+            # Draw Mhalo from Mstar, and then c from Mhalo:
+            Mh = model.drawMhalos(Mstar.ravel(),z.ravel()).reshape(n,N)
+            M200 = 10**Mh
+            r200 = (3*M200/(800*3.14159*rho_crit))**(1./3)
+            c200 = pangloss.MCrelation(M200.ravel(),scatter=True).reshape(n,N)
+            r_s = r200/c200
+            x = rphys/r_s
+
+            # Compute each halo's contribution to the convergence:
+            rho_s = pangloss.delta_c(c200)*rho_crit
+            kappa_s = rho_s*r_s/sigma_crit
+            xtrunc = truncationscale*r200/r_s
+            if table is not None:
+                assert table.profile == profile
+                F,G = table.evaluate(x,xtrunc)
+            elif profile in ("BMO1","BMO2"):
+                FGfunc = pangloss.BMO1FGfunc if profile == "BMO1" else pangloss.BMO2FGfunc
+                F,G = FGfunc(x.ravel(),xtrunc.ravel(),Fbuf[:n*N],Gbuf[:n*N])
+                F,G = F.reshape(n,N),G.reshape(n,N)
+            elif profile == "NFW":
+                F = pangloss.Ffunc(x.ravel()).reshape(n,N)
+                G = F + pangloss.Gfunc(x.ravel()).reshape(n,N)
+            else:
+                raise ValueError("Unknown profile %s" % profile)
+            kappa = kappa_s*F
+            gamma = kappa_s*(G-F)
+            gamma1 = -gamma*numpy.cos(2*phi)
+            gamma2 = -gamma*numpy.sin(2*phi)
+
+            # Combine them along the line of sight:
+            K = kappa
+            values = combine(beta,K,gamma,gamma1,gamma2)
+            for key in keys:
+                totals[key][j:j+n] = values[key].sum(axis=1)
+
+            # The same halos, lensing each source in turn:
+            if zsources is not None:
+                for k in range(len(zsources)):
+                    w = sigma_crit/grid.sigma_crit_zs[k][planes]
+                    valuesk = combine(grid.beta_zs[k][planes],w*K,w*gamma,w*gamma1,w*gamma2)
+                    for key in keys:
+                        totals[key+'_zs'][j:j+n,k] = valuesk[key].sum(axis=1)
+
+            # Keep the first realisation in the galaxy table:
+            if j == 0:
+                columns = dict(z=z,Da_p=Da_p,rho_crit=rho_crit,sigma_crit=sigma_crit,
+                               beta=beta,rphys=rphys,Mstar=Mstar,Mh=Mh,r200=r200,
+                               c200=c200,rs=r_s,X=x,kappa=K,gamma=gamma,
+                               gamma1=gamma1,gamma2=gamma2,
+                               mu=1.0/(((1.0 - K)**2.0) - (gamma**2.0)))
+                if self.flavor == 'simulated': columns['Mstar_obs'] = Mstar_obs
+                columns.update(values)
+                for key in sorted(columns.keys()):
+                    self.writeColumn(key,columns[key][0])
+                self.kappa_s = kappa_s[0]
+                for key in keys:
+                    setattr(self,key+'_total',totals[key][0])
+
+        return totals
+
 # ----------------------------------------------------------------------------
 # Calculate magnification along line of sight
 
@@ -468,6 +777,14 @@ class Lightcone(object):
             
         self.mu_add_total=Msum
 
+        if getattr(self,'zsources',None) is not None:
+            Ksum = self.kappa_add_total_zs
+            if weakapprox is True:
+                self.mu_add_total_zs = 1.0 + 2.0*Ksum
+            else:
+                Gsum2 = self.gamma1_zs.sum(axis=1)**2 + self.gamma2_zs.sum(axis=1)**2
+                self.mu_add_total_zs = 1.0/((1.0 - Ksum)**2.0 - Gsum2)
+
         return self.mu_add_total       
 
 # ----------------------------------------------------------------------------
@@ -716,4 +1033,146 @@ class Lightcone(object):
 # ----------------------------------------------------------------------------
     
 
+#=============================================================================
+# Combine each halo's convergence and shear along the line of sight, given
+# its beta, in the three ways Lightcone does: returns a dictionary of arrays
+# keyed by kappa_add, kappa_keeton, kappa_tom and the same for gamma1 and
+# gamma2.
+
+def combine(B,K,gamma,gamma1,gamma2):
+
+    D = K**2-gamma**2
+    denominator = (1-B*K)**2 - (B*gamma)**2
+    kappa_keeton = (1.-B)*(K-B*D)/denominator
+    gamma1_keeton = (1.-B)*gamma1/denominator
+    gamma2_keeton = (1.-B)*gamma2/denominator
+    kappa_tom = (1.-B)*K
+    gamma1_tom = (1.-B)*gamma1
+    gamma2_tom = (1.-B)*gamma2
+
+    return dict(kappa_add=K,kappa_keeton=kappa_keeton,kappa_tom=kappa_tom,
+                gamma1_add=gamma1,gamma1_keeton=gamma1_keeton,gamma1_tom=gamma1_tom,
+                gamma2_add=gamma2,gamma2_keeton=gamma2_keeton,gamma2_tom=gamma2_tom)
+
+#=============================================================================
+# Catalog column holding magnitudes in a given band. Everything that
+# selects galaxies by band (the depth cut when drilling, galaxiesWithin,
+# configureForSurvey and Configuration.getCatalogColumns) uses this, so
+# that they all agree on which column a band means:
+
+def magnitudeColumn(band):
+
+    if band == "u" or band ==  "g" or band == "r" or band ==  "i" or band == "z":
+        col = "mag_SDSS_%s" % band
+    elif band == "F814" or band == "F814W" or band == "814" or band == 814:
+        col = "mag_F814W" #note that this isn't included atm
+    elif band == "WFC125" or band == "F125" or band == "F125W" or band == "125" or band == 125:
+        col = "WFC125" #this was the matching band for BoRG
+    else:
+        col = "mag_%s" % band
+
+    return col
+
+#=============================================================================
+# Decide which (cone,row) pairs from a square cut are cone members, as
+# Lightcone does: inside the circle, not type 2, and within any depth and
+# redshift limits. Returns a boolean mask over the pairs.
+
+def coneMembers(catalog,positions,radius,cones,rows,maglimit=99,band="r",zmax=None):
+
+    x = catalog['nRA'][rows] - positions[cones,0]
+    y = catalog['Dec'][rows] - positions[cones,1]
+    keep = numpy.sqrt(x*x + y*y)*pangloss.rad2arcmin < radius
+
+    # Drop type 2 galaxies, if the catalog has types:
+    if 'Type' in catalog.keys():
+        keep &= (catalog['Type'][rows] != 2)
+
+    col = magnitudeColumn(band)
+    if maglimit < 99 and col in catalog.keys():
+        keep &= (catalog[col][rows] < maglimit)
+    if zmax is not None:
+        keep &= (catalog['z_obs'][rows] < zmax)
+
+    return keep
+
+#=============================================================================
+# Drill many lightcones out of one catalog. All cones in a batch have their
+# galaxies assigned (square cut, circle trim, Type != 2 filter and any depth
+# and redshift limits) in one vectorized pass over the catalog index; cones
+# may overlap. This is a generator, yielding one Lightcone at a time in the
+# order of positions, so that the caller can write each one out and discard
+# it.
+
+def drillLightcones(catalog,flavor,positions,radius,maglimit=99,band="r",zmax=None,index=None,batchsize=1000):
+
+    if index is None: index = pangloss.SkyIndex(catalog,radius)
+    positions = numpy.atleast_2d(positions)
+
+    for first in range(0,len(positions),batchsize):
+        batch = positions[first:first+batchsize]
+
+        cones,rows = index.queryMany(batch,radius)
+        keep = coneMembers(catalog,batch,radius,cones,rows,maglimit,band,zmax)
+        cones,rows = cones[keep],rows[keep]
+
+        # Pairs are sorted by cone, so each cone is one slice of rows:
+        counts = numpy.bincount(cones,minlength=len(batch))
+        end = numpy.cumsum(counts)
+        start = end - counts
+        for k in range(len(batch)):
+            yield Lightcone(catalog,flavor,batch[k],radius,maglimit,band,zmax,
+                            index=index,rows=rows[start[k]:end[k]])
+
+    return
+
+#=============================================================================
+# Drill many lightcones out of a catalog that is read in chunks of rows (see
+# io.readCatalogChunks), so that the whole catalog never has to be in memory.
+# Each chunk's rows are routed to all the cones they fall in, and the cones
+# are only finished once every chunk has been seen, so this is a generator
+# that yields nothing until the last chunk is done. limits are the
+# (xmin,xmax,ymin,ymax) of the whole catalog, which each Lightcone records.
+
+def drillLightconesFromChunks(chunks,flavor,positions,radius,limits,maglimit=99,band="r",zmax=None):
+
+    positions = numpy.atleast_2d(positions)
+    pieces = [[] for k in range(len(positions))]
+
+    # An index over just the catalog corners carries its limits:
+    xmin,xmax,ymin,ymax = limits
+    bounds = pangloss.SkyIndex({'nRA':[xmin,xmax],'Dec':[ymin,ymax]},radius)
+
+    # The cones' galaxy tables take their columns from the chunks, so that
+    # cones with no galaxies still have them:
+    dtype = None
+    for chunk in chunks:
+        if dtype is None:
+            dtype = numpy.dtype([(name,chunk[name].dtype) for name in chunk.keys()])
+        if len(chunk) == 0: continue
+        index = pangloss.SkyIndex(chunk,radius)
+        cones,rows = index.queryMany(positions,radius)
+        keep = coneMembers(chunk,positions,radius,cones,rows,maglimit,band,zmax)
+        cones,rows = cones[keep],rows[keep]
+
+        # Keep just the member rows, cone by cone, in catalog order:
+        members = chunk.rows(rows).data
+        counts = numpy.bincount(cones,minlength=len(positions))
+        end = numpy.cumsum(counts)
+        start = end - counts
+        for k in numpy.where(counts > 0)[0]:
+            pieces[k].append(members[start[k]:end[k]])
+
+    if dtype is None:
+        raise ValueError("drillLightconesFromChunks: no catalog chunks to drill")
+
+    for k in range(len(positions)):
+        data = numpy.concatenate(pieces[k]) if len(pieces[k]) > 0 \
+               else numpy.zeros(0,dtype=dtype)
+        pieces[k] = None
+        yield Lightcone(data,flavor,positions[k],radius,maglimit,band,zmax,
+                        index=bounds,rows=numpy.arange(len(data)))
+
+    return
+
 #=============================================================================
@@ -0,0 +1,248 @@
+# ===========================================================================
+
+import pangloss
+
+import os,glob,numpy
+
+# ============================================================================
+
+class LightconeStore(object):
+    """
+    NAME
+        LightconeStore
+
+    PURPOSE
+        Keep a large set of calibration lightcones in a few big files,
+        instead of one pickle per cone, and give random access to any
+        of them by pointing number.
+
+    COMMENTS
+        The store is a folder of shards. Each shard holds a batch of
+        cones drilled from the same catalog: their galaxy tables,
+        concatenated into one numpy structured array (shard.npy), and an
+        index (shard.pickle) of where each cone's galaxies start and how
+        many there are, along with the rest of each Lightcone's
+        attributes - centre, radius, kappa_hilbert and so on. Reading a
+        cone memory-maps its shard and copies out just that cone's rows,
+        so no other cone is ever unpickled. Shards are written under
+        temporary names and moved into place index last, so several
+        processes can add shards to one store at the same time, and
+        readers never see half a shard. The folder is only made when the
+        first shard is written, so opening a store just to read it never
+        leaves an empty one behind; reading from a store that is missing
+        or empty raises an IOError.
+
+    INITIALISATION
+        folder        Directory holding the shards (made by the first write)
+
+    METHODS
+        refresh(self): re-read the shard indices, to pick up new shards
+
+        write(self,cones,pointings): add a list of Lightcones as a new
+          shard, named after the first pointing number
+
+        read(self,pointing): return the Lightcone with this pointing
+          number
+
+        metadata(self,pointing): return the stored attributes of a cone,
+          including its number of galaxies N, without reading it
+
+        filename(self,pointing): the shard data file holding a cone
+
+        pointings(self): return the sorted list of pointing numbers
+
+        check(self): raise IOError if the store has no cones in it
+
+    BUGS
+        - All the cones in one shard must have the same catalog columns.
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,folder):
+
+        self.name = 'Sharded store of lightcone catalogs'
+        self.folder = folder
+
+        # Memory-mapped shard data, opened as needed:
+        self.shards = {}
+
+        self.refresh()
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Lightcone store of %i cones in %s' % (len(self.index),self.folder)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self,pointing):
+        return pointing in self.index
+
+# ----------------------------------------------------------------------------
+# Build the pointing -> (shard, cone metadata) lookup from the shard indices:
+
+    def refresh(self):
+        self.index = {}
+        for indexfile in glob.glob(os.path.join(self.folder,'shard_*.pickle')):
+            shard = os.path.basename(indexfile).split('.')[0]
+            for meta in pangloss.readPickle(indexfile):
+                self.index[meta['pointing']] = (shard,meta)
+        return
+
+    def pointings(self):
+        self.check()
+        return sorted(self.index.keys())
+
+# A store with no cones in it has almost certainly not been made yet:
+
+    def check(self):
+        if len(self.index) == 0:
+            raise IOError("LightconeStore: no lightcones in "+self.folder+" (missing or empty) - has Drill been run with LightconeStore: True?")
+        return
+
+    def metadata(self,pointing):
+        return self.index[pointing][1]
+
+    def filename(self,pointing):
+        return os.path.join(self.folder,self.index[pointing][0]+'.npy')
+
+# ----------------------------------------------------------------------------
+
+    def write(self,cones,pointings):
+
+        assert len(cones) == len(pointings)
+        if len(cones) == 0: return
+
+        shard = 'shard_%i' % pointings[0]
+        datafile = os.path.join(self.folder,shard+'.npy')
+        indexfile = os.path.join(self.folder,shard+'.pickle')
+
+        # Everything except the galaxy tables goes in the index:
+        metas,offset = [],0
+        for lc,pointing in zip(cones,pointings):
+            meta = dict((key,value) for key,value in lc.__dict__.items()
+                        if key not in ('galaxies','allgalaxies','stale'))
+            meta['pointing'] = pointing
+            meta['offset'] = offset
+            meta['N'] = len(lc.galaxies)
+            metas.append(meta)
+            offset += meta['N']
+
+        data = numpy.concatenate([lc.galaxies.data for lc in cones])
+
+        # (Other processes may be making the folder at the same time.)
+        try:
+            os.makedirs(self.folder)
+        except OSError:
+            if not os.path.isdir(self.folder): raise
+
+        tmp = '.tmp%i' % os.getpid()
+        F = open(datafile+tmp,"wb")
+        numpy.save(F,data)
+        F.close()
+        os.rename(datafile+tmp,datafile)
+        pangloss.writePickle(metas,indexfile)
+
+        for meta in metas:
+            self.index[meta['pointing']] = (shard,meta)
+        self.shards.pop(shard,None)
+
+        return
+
+# ----------------------------------------------------------------------------
+
+    def read(self,pointing):
+
+        self.check()
+        shard,meta = self.index[pointing]
+
+        if shard not in self.shards:
+            datafile = os.path.join(self.folder,shard+'.npy')
+            self.shards[shard] = numpy.load(datafile,mmap_mode='r')
+        data = self.shards[shard][meta['offset']:meta['offset']+meta['N']]
+
+        # Rebuild the Lightcone without re-drilling it, as unpickling would:
+        lc = pangloss.Lightcone.__new__(pangloss.Lightcone)
+        lc.__dict__.update((key,value) for key,value in meta.items()
+                           if key not in ('pointing','offset','N'))
+        lc.galaxies = pangloss.Galaxies(data)
+        lc.allgalaxies = lc.galaxies
+
+        return lc
+
+# ============================================================================
+
+if __name__ == '__main__':
+
+    import tempfile,shutil
+
+    print "Testing LightconeStore..."
+
+    # Some mock calibration lightcones:
+    rng = numpy.random.RandomState(7)
+    N = 5000
+    catalog = pangloss.Galaxies({'nRA':rng.uniform(-0.01,0.01,N),
+                                 'Dec':rng.uniform(-0.01,0.01,N),
+                                 'z_obs':rng.uniform(0.,3.,N),
+                                 'Mhalo_obs':10**rng.uniform(10.,14.,N),
+                                 'Type':rng.randint(0,3,N)})
+    positions = rng.uniform(-0.008,0.008,(6,2))
+    cones = list(pangloss.drillLightcones(catalog,'simulated',positions,2.0))
+    for k,lc in enumerate(cones):
+        lc.kappa_hilbert = 0.01*k
+
+    parent = tempfile.mkdtemp()
+    folder = os.path.join(parent,'lightcones')
+    try:
+        # Opening a store that has not been written does not make it, and
+        # reading from it fails:
+        store = LightconeStore(folder)
+        assert not os.path.exists(folder)
+        try:
+            store.pointings()
+            assert False, "read an empty store"
+        except IOError:
+            pass
+
+        # Two shards, read back through a fresh store:
+        store.write(cones[:4],range(0,4))
+        store.write(cones[4:],range(4,6))
+        store = LightconeStore(folder)
+        assert len(store) == 6 and store.pointings() == range(6)
+
+        for k,lc in enumerate(cones):
+            assert store.metadata(k)['N'] == len(lc.galaxies)
+            again = store.read(k)
+            assert again.xc == lc.xc and again.rmax == lc.rmax
+            assert again.kappa_hilbert == lc.kappa_hilbert
+            assert again.galaxies.keys() == lc.galaxies.keys()
+            for name in lc.galaxies.keys():
+                assert numpy.array_equal(again.galaxies[name],lc.galaxies[name])
+
+            # Read cones are ordinary, writeable Lightcones:
+            again.galaxies['z'] = 0.
+            assert (store.read(k).galaxies.z == lc.galaxies.z).all()
+
+        # Re-writing a shard replaces all of its cones:
+        store.write(cones[5:],[0])
+        store = LightconeStore(folder)
+        assert store.pointings() == [0,4,5]
+        assert store.read(0).kappa_hilbert == cones[5].kappa_hilbert
+    finally:
+        shutil.rmtree(parent)
+
+    print "...done."
+
+# ============================================================================
@@ -0,0 +1,87 @@
+# ===========================================================================
+
+import pangloss
+
+import numpy
+import distances
+
+# ============================================================================
+
+class MultiSourceGrid(pangloss.Grid):
+    """
+    NAME
+        MultiSourceGrid
+
+    PURPOSE
+        A redshift Grid that also holds the lensing weights for a set of
+        source redshifts, so that one halo realisation of a lightcone
+        gives kappa and mu for every source at once.
+
+    COMMENTS
+        The planes, and all the usual Grid quantities, are those of a
+        Grid whose source is the deepest of zsources. For each source k,
+        sigma_crit_zs[k] and beta_zs[k] give the critical density and
+        beta of every plane: only these change with the source, so each
+        halo's kappa for source k is just its kappa for the deepest
+        source, times sigma_crit/sigma_crit_zs[k]. Halos behind a source
+        do not lens it, so sigma_crit_zs is infinite for planes beyond
+        it. (Grid does not do this, so the deepest source's row can differ
+        from sigma_crit in the last plane.) Lightcone.loadGrid picks up the
+        weights; makeKappas, combineKappas and combineMus then fill in
+        arrays of kappa, gamma and mu for each source (kappa_zs,
+        kappa_add_total_zs, mu_add_total_zs and so on), as does
+        drawRealisations.
+
+    INITIALISATION
+        zl            Strong lens redshift (needed for critical densities etc)
+        zsources      Source plane redshifts
+        nplanes       Number of redshift planes in grid (def=100)
+        cosmo         Cosmological parameters (def: [Om,Ol,h]=[0.25,0.75,0.73]
+        spacing       Plane spacing, as for Grid (def: "redshift"), with
+                        the deepest source's lensing kernel
+
+    METHODS
+        snap(self,z): Return redshift of nearest plane to z
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,zl,zsources,nplanes=100,cosmo=[0.25,0.75,0.73],spacing="redshift"):
+
+        self.zsources = numpy.atleast_1d(numpy.array(zsources,dtype=numpy.float64))
+        self.Nsources = len(self.zsources)
+        assert self.zsources.min() > zl
+
+        pangloss.Grid.__init__(self,zl,self.zsources.max(),nplanes=nplanes,cosmo=cosmo,spacing=spacing)
+        self.name = '1D Redshift grid of lens planes, with precalculated quantities for %i sources' % self.Nsources
+
+        # Distances to each source, as columns to broadcast over planes:
+        D = distances.Distance(cosmo)
+        D.tabulate(zmax=max(10.,self.zs))
+        zs = self.zsources[:,numpy.newaxis]
+        self.Da_s_zs = D.Da(zs)
+        self.Da_ls_zs = D.Da(zl,zs)
+        self.Da_ps_zs = D.Da(self.redshifts,zs)
+        self.sigma_crit_zs,self.beta_zs = self.weights(self.Da_p,self.Da_ps_zs,self.Da_pl,
+                                                       self.Da_l,self.Da_s_zs,self.Da_ls_zs)
+        self.sigma_crit_zs[self.redshifts > zs] = numpy.inf
+        self.Da_s_zs,self.Da_ls_zs = self.Da_s_zs[:,0],self.Da_ls_zs[:,0]
+
+        return
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return pangloss.Grid.__str__(self)+', for sources at z = %s' % ', '.join(['%.2f' % z for z in self.zsources])
+
+# ============================================================================
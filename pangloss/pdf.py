@@ -24,6 +24,8 @@ class PDF(object):
         
     METHODS
         append(self,sample): add a sample (or numpy array of samples) to the ensemble
+
+        extend(self,samples): add many samples at once, as an (N x Ndim) array
     
     BUGS
 
@@ -64,6 +66,13 @@ class PDF(object):
         self.samples = numpy.append(self.samples,[sample],axis=0)
         return 
 
+# Add many samples to the ensemble in one go:
+
+    def extend(self,samples):
+        samples = numpy.asarray(samples).reshape(-1,self.Ndim)
+        self.samples = numpy.append(self.samples,samples,axis=0)
+        return 
+
 # ----------------------------------------------------------------------------
 # Extract samples in one parameter:
    
@@ -3,9 +3,13 @@
 
 import pangloss
 
-import numpy
+import os,hashlib,numpy
 from scipy import interpolate,optimize
 
+# Version of the on-disk SHMR cache: increase this whenever SHMR changes how
+# it makes its grids, so that stale caches are not re-used:
+shmrCacheVersion = 1
+
 # ============================================================================
 
 class SHMR(object):
@@ -27,6 +31,12 @@ class SHMR(object):
         estimated empirically from a halo catalog, which must be
         supplied.
 
+        Making the grids takes a while, so they can be cached on disk,
+        as plain arrays, in a folder named after a hash of everything
+        they depend on: the method, the grid axes, the scatter, the
+        contents of the HMF catalog, and the cache version. A changed
+        input gives a new cache name, and so a rebuild.
+
     INITIALISATION
         method        Whose relation to use. Default = 'Behroozi'
 
@@ -45,6 +55,14 @@ class SHMR(object):
 
         makeCDFs(self): are these actually CDFs?
 
+        cacheName(self,folder,HMFcatalog): where to cache the grids made
+          from this HMF catalog
+
+        writeCache(self,cachename): save the grids
+
+        readCache(self,cachename): load the grids, if they have been
+          saved; returns True if so
+
         Mstar_to_M200(self,M_Star,redshift):
 
     BUGS
@@ -71,6 +89,10 @@ class SHMR(object):
         self.Mh_axis = numpy.linspace(10.,20.,self.nMh)
         self.Ms_axis = numpy.linspace(8.,13.,self.nMs)
         self.zed_axis,self.dz  = numpy.linspace(0.,1.6,self.nz,retstep=True)
+        self.X_axis = numpy.linspace(0.,1.,self.nMh)
+
+        # Intrinsic Mstar scatter of the Behroozi relation:
+        self.scatter = 0.15
         
         return None
 
@@ -85,8 +107,7 @@ class SHMR(object):
     def drawMstars(self,Mh,z):
         assert len(Mh)==len(z)
         MstarBest = self.H2S_model.eval(numpy.array([Mh,z]).T)
-        Mstar = MstarBest + numpy.random.randn(len(Mh))*0.15
-        # 0.15 is the intrinsic Mstar scatter of the Behroozi relation...
+        Mstar = MstarBest + numpy.random.randn(len(Mh))*self.scatter
         return Mstar
 
 # ----------------------------------------------------------------------------
@@ -216,7 +237,7 @@ class SHMR(object):
             H2S_grid[:,k]=MsMean
         
             # Now we can make Pr(M*|Mh):
-            sigma=0.15
+            sigma=self.scatter
             norm = sigma*(2*numpy.pi)**0.5
             pdflist = numpy.empty((Ms.size,Mh.size))
             for j in range(Mh.size):
@@ -237,7 +258,7 @@ class SHMR(object):
 
             CDF = numpy.empty((cdf.shape[0],Mh.size))
             # BUG: do not use case-sensitive variables!
-            X = numpy.linspace(0.,1.,Mh.size)
+            X = self.X_axis
             for j in range(Ms.size):
             # Take care of numerical stability...
                 tmp = numpy.round(cdf[j]*1e5).astype(numpy.int64)/1e5
@@ -249,20 +270,84 @@ class SHMR(object):
                 CDF[j] = interpolate.splev(X,mod)
             S2H_grid[:,:,k] = CDF 
             
+        self.makeModels(S2H_grid,H2S_grid)
+        
+        return
+
+# ----------------------------------------------------------------------------
+# Interpolate the grids: Mh(M*,X,z), and the zero-scatter halo to stellar
+# mass relation M*(Mh,z). The spline coefficients can be passed in, if
+# they are already known, to save re-computing them:
+
+    def makeModels(self,S2H_grid,H2S_grid,S2H_spline=None,H2S_spline=None):
+
+        Mh,Ms,X,zeds = self.Mh_axis,self.Ms_axis,self.X_axis,self.zed_axis
+
         # Form Mh(M*,X)
         axes = {}
         axes[0] = interpolate.splrep(Ms,numpy.arange(Ms.size),k=1)
         axes[1] = interpolate.splrep(X,numpy.arange(X.size),k=1)
         axes[2] = interpolate.splrep(zeds,numpy.arange(zeds.size),k=1)
-        self.S2H_model = pangloss.ndInterp(axes,S2H_grid)
             
         # Make the zero-scatter halo to stellar mass relation.
         axes2 = {}
         axes2[0] = interpolate.splrep(Mh,numpy.arange(Mh.size),k=1)
         axes2[1] = interpolate.splrep(zeds,numpy.arange(zeds.size),k=1)
-        self.H2S_model = pangloss.ndInterp(axes2,H2S_grid)        
-        
+
+        if S2H_spline is None:
+            self.S2H_model = pangloss.ndInterp(axes,S2H_grid)
+            self.H2S_model = pangloss.ndInterp(axes2,H2S_grid)
+        else:
+            # (order=1 skips the spline filtering, which we then undo:)
+            self.S2H_model = pangloss.ndInterp(axes,S2H_grid,order=1)
+            self.S2H_model.spline,self.S2H_model.order = S2H_spline,3
+            self.H2S_model = pangloss.ndInterp(axes2,H2S_grid,order=1)
+            self.H2S_model.spline,self.H2S_model.order = H2S_spline,3
+
         return
+
+# ----------------------------------------------------------------------------
+# Cache the grids (and the spline coefficients interpolating them) as
+# plain arrays, that load in a moment:
+
+    def cacheName(self,folder,HMFcatalog):
+        key = hashlib.md5()
+        key.update(repr(shmrCacheVersion))
+        key.update(self.method)
+        key.update(repr(self.scatter))
+        for axis in (self.Mh_axis,self.Ms_axis,self.X_axis,self.zed_axis):
+            key.update(numpy.ascontiguousarray(axis,dtype=numpy.float64).tostring())
+        F = open(HMFcatalog,'rb')
+        for block in iter(lambda: F.read(2**20),''):
+            key.update(block)
+        F.close()
+        return os.path.join(folder,'SHMR_'+key.hexdigest())
+
+    def writeCache(self,cachename):
+        nz = len(self.HMFzkeys)
+        HMF = numpy.array([self.HMF[i] for i in range(nz)])
+        arrays = [('S2H_grid',self.S2H_model.z),('S2H_spline',self.S2H_model.spline),
+                  ('H2S_grid',self.H2S_model.z),('H2S_spline',self.H2S_model.spline),
+                  ('HMF',HMF),('HMFzkeys',self.HMFzkeys)]
+        info = {'method':self.method,'HMFcatalog':self.HMF['catalog'],'HMFdz':self.HMFdz,
+                'cacheversion':shmrCacheVersion}
+        pangloss.writeArrays(arrays,cachename,info=info)
+        return
+
+    def readCache(self,cachename):
+        try:
+            names,arrays,info = pangloss.readArrays(cachename)
+        except IOError:
+            return False
+        if info.get('cacheversion') != shmrCacheVersion:
+            return False
+        self.HMF = {'catalog':info['HMFcatalog']}
+        for i in range(len(arrays['HMF'])):
+            self.HMF[i] = numpy.array(arrays['HMF'][i])
+        self.HMFzkeys,self.HMFdz = numpy.array(arrays['HMFzkeys']),info['HMFdz']
+        self.makeModels(arrays['S2H_grid'],arrays['H2S_grid'],
+                        arrays['S2H_spline'],arrays['H2S_spline'])
+        return True
         
 # ----------------------------------------------------------------------
 # Takes an array of stellar mass and an array of redshifts, and returns 
@@ -0,0 +1,206 @@
+# ===========================================================================
+
+import pangloss
+
+import numpy
+
+# ============================================================================
+
+class SkyIndex(object):
+    """
+    NAME
+        SkyIndex
+
+    PURPOSE
+        Spatial index over the sky positions of a large galaxy catalog,
+        so that the galaxies near any given point can be found without
+        scanning the whole table.
+
+    COMMENTS
+        The catalog rows are binned into a uniform grid of square cells
+        in (nRA,Dec), and sorted by cell. A query then only has to look
+        at the rows in the handful of cells that overlap the requested
+        square. Build the index once per catalog, and pass it to every
+        Lightcone drilled from that catalog. Positions are in radians,
+        as in the catalog; sizes are in arcmin, as in the config file.
+
+    INITIALISATION
+        catalog       Parent galaxy table, with nRA and Dec columns (rad)
+        cellsize      Side of each index cell (arcmin) - the lightcone
+                        radius is a good choice
+
+    METHODS
+        cellsOf(self,x,y): return the cell numbers of positions x,y
+
+        query(self,position,radius): return the (sorted) row numbers of
+          all catalog galaxies in the square of half-side radius (arcmin)
+          centred on position
+
+        queryMany(self,positions,radius): as query, but for many positions
+          at once - returns matching arrays of cone and row numbers
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,catalog,cellsize):
+
+        self.name = 'Uniform cell grid over catalog sky positions'
+
+        x = numpy.array(catalog['nRA'],dtype=numpy.float64)
+        y = numpy.array(catalog['Dec'],dtype=numpy.float64)
+        self.N = len(x)
+
+        # Catalog limits, so that Lightcones don't need to recompute them:
+        self.xmax,self.xmin = x.max(),x.min()
+        self.ymax,self.ymin = y.max(),y.min()
+
+        # Cell grid covering the whole catalog:
+        self.cellsize = cellsize*pangloss.arcmin2rad
+        self.nx = int((self.xmax-self.xmin)/self.cellsize) + 1
+        self.ny = int((self.ymax-self.ymin)/self.cellsize) + 1
+
+        # Sort rows by cell (stably, so rows stay in catalog order within
+        # each cell), and record where each cell starts in the sorted list:
+        cells = self.cellsOf(x,y)
+        self.order = numpy.argsort(cells,kind='mergesort')
+        counts = numpy.bincount(cells,minlength=self.nx*self.ny)
+        self.start = numpy.concatenate(([0],numpy.cumsum(counts)))
+
+        # Keep positions in sorted order, for the exact cut in query:
+        self.x = x[self.order]
+        self.y = y[self.order]
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Sky index of %i galaxies in %ix%i cells of side %.2f arcmin' % (self.N,self.nx,self.ny,self.cellsize*pangloss.rad2arcmin)
+
+# ----------------------------------------------------------------------------
+
+    def cellsOf(self,x,y):
+        i = numpy.clip(((x - self.xmin)/self.cellsize).astype(int),0,self.nx-1)
+        j = numpy.clip(((y - self.ymin)/self.cellsize).astype(int),0,self.ny-1)
+        return i*self.ny + j
+
+# ----------------------------------------------------------------------------
+# Return the catalog row numbers of all galaxies in a square around a
+# given position, in catalog order:
+
+    def query(self,position,radius):
+
+        xc,yc = position[0],position[1]
+        dx = radius*pangloss.arcmin2rad
+
+        # Range of cells overlapped by the square:
+        i0 = int(numpy.clip((xc-dx-self.xmin)/self.cellsize,0,self.nx-1))
+        i1 = int(numpy.clip((xc+dx-self.xmin)/self.cellsize,0,self.nx-1))
+        j0 = int(numpy.clip((yc-dx-self.ymin)/self.cellsize,0,self.ny-1))
+        j1 = int(numpy.clip((yc+dx-self.ymin)/self.cellsize,0,self.ny-1))
+
+        # Cells i*ny+j0 to i*ny+j1 are contiguous in the sorted list, so
+        # gather the rows in those cells one column of cells at a time:
+        spans = [(self.start[i*self.ny+j0],self.start[i*self.ny+j1+1]) for i in range(i0,i1+1)]
+        k = numpy.concatenate([numpy.arange(a,b) for a,b in spans]).astype(int)
+
+        # Exact square cut, as in Lightcone:
+        x,y = self.x[k],self.y[k]
+        keep = (x > (xc-dx)) & (x < (xc+dx)) & (y > (yc-dx)) & (y < (yc+dx))
+
+        return numpy.sort(self.order[k[keep]])
+
+# ----------------------------------------------------------------------------
+# Assign catalog rows to many squares in one vectorized pass. Squares may
+# overlap, in which case a row appears once for each square it is in. The
+# (cone,row) pairs come back sorted by cone, and then by row:
+
+    def queryMany(self,positions,radius):
+
+        positions = numpy.atleast_2d(positions)
+        xc,yc = positions[:,0],positions[:,1]
+        dx = radius*pangloss.arcmin2rad
+
+        # Range of cells overlapped by each square:
+        i0 = numpy.clip((xc-dx-self.xmin)/self.cellsize,0,self.nx-1).astype(int)
+        i1 = numpy.clip((xc+dx-self.xmin)/self.cellsize,0,self.nx-1).astype(int)
+        j0 = numpy.clip((yc-dx-self.ymin)/self.cellsize,0,self.ny-1).astype(int)
+        j1 = numpy.clip((yc+dx-self.ymin)/self.cellsize,0,self.ny-1).astype(int)
+
+        # One span of the sorted list per (cone, column of cells):
+        ncols = i1 - i0 + 1
+        c = numpy.repeat(numpy.arange(len(xc)),ncols)
+        first = numpy.cumsum(ncols) - ncols
+        i = i0[c] + numpy.arange(len(c)) - first[c]
+        a = self.start[i*self.ny+j0[c]]
+        b = self.start[i*self.ny+j1[c]+1]
+
+        # Expand the spans into (cone, sorted position) pairs:
+        n = b - a
+        offset = numpy.cumsum(n) - n
+        cones = numpy.repeat(c,n)
+        k = numpy.arange(n.sum()) - numpy.repeat(offset-a,n)
+
+        # Exact square cut:
+        x,y = self.x[k],self.y[k]
+        keep = (x > (xc[cones]-dx)) & (x < (xc[cones]+dx)) & \
+               (y > (yc[cones]-dx)) & (y < (yc[cones]+dx))
+        cones,rows = cones[keep],self.order[k[keep]]
+
+        s = numpy.lexsort((rows,cones))
+        return cones[s],rows[s]
+
+# ============================================================================
+
+if __name__ == '__main__':
+
+    print "Testing SkyIndex..."
+
+    # A mock catalog, 0.02 rad on a side:
+    rng = numpy.random.RandomState(42)
+    N = 20000
+    catalog = pangloss.Galaxies({'nRA':rng.uniform(-0.01,0.01,N),
+                                 'Dec':rng.uniform(-0.01,0.01,N),
+                                 'z_obs':rng.uniform(0.,3.,N),
+                                 'Mhalo_obs':10**rng.uniform(10.,14.,N),
+                                 'mag_SDSS_r':rng.uniform(18.,28.,N),
+                                 'Type':rng.randint(0,3,N)})
+    radius = 2.0
+    index = SkyIndex(catalog,radius)
+
+    # Cones in the middle, at the edges and corners, and off the catalog:
+    positions = numpy.vstack([rng.uniform(-0.01,0.01,(50,2)),
+                              [[-0.01,-0.01],[0.01,0.01],[0.,0.01],[0.02,0.]]])
+
+    # query and queryMany find the same rows as a full scan of the catalog:
+    cones,rows = index.queryMany(positions,radius)
+    dx = radius*pangloss.arcmin2rad
+    for k,(xc,yc) in enumerate(positions):
+        brute = numpy.where((catalog.nRA > (xc-dx)) & (catalog.nRA < (xc+dx)) & \
+                            (catalog.Dec > (yc-dx)) & (catalog.Dec < (yc+dx)))[0]
+        assert numpy.array_equal(index.query((xc,yc),radius),brute)
+        assert numpy.array_equal(rows[cones == k],brute)
+
+    # So drillLightcones makes the same cones as a brute-force Lightcone,
+    # with and without depth and redshift cuts:
+    for cuts in ({},{'maglimit':24.,'band':'r','zmax':1.6}):
+        drilled = pangloss.drillLightcones(catalog,'simulated',positions,radius,index=index,batchsize=16,**cuts)
+        for k,lc in enumerate(drilled):
+            brute = pangloss.Lightcone(catalog,'simulated',positions[k],radius,**cuts)
+            assert lc.galaxies.keys() == brute.galaxies.keys()
+            for name in brute.galaxies.keys():
+                assert numpy.array_equal(lc.galaxies[name],brute.galaxies[name])
+
+    print "...done."
+
+# ============================================================================